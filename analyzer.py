@@ -0,0 +1,117 @@
+import threading
+import time
+import numpy as np
+
+FFT_SIZE = 2048
+FPS = 30
+# Spectrum floor in dB, keeps log10 away from zero
+FLOOR = -120.0
+
+# numpy 2 can write rfft output into an existing array
+try:
+    np.fft.rfft(np.zeros(2), out=np.zeros(2, dtype=complex))
+    RFFT_OUT = True
+except TypeError:
+    RFFT_OUT = False
+
+
+class Analyzer:
+    # Spectrum of the synth's own output, read out of a SampleRing on a
+    # worker thread. The audio callback's only cost is the ring write; the
+    # analyzer never opens a stream. Frames go into one of two buffers
+    # while readers look at the other, published fps times a second.
+    def __init__(self, ring, size=FFT_SIZE, rate=48000, fps=FPS, full_scale=32768):
+        self.ring = ring
+        self.size = size
+        self.period = 1 / fps
+        self.freqs = np.fft.rfftfreq(size, 1 / rate)
+        self.window = np.hanning(size).astype(np.float32)
+        # A full scale sine reads 0 dB
+        self.full_scale = full_scale
+        self.scale = 2 / (self.window.sum() * full_scale)
+        self.frame = np.empty(size, dtype=np.float32)
+        self.bins = np.empty(size // 2 + 1, dtype=np.complex128)
+        self.waves = np.zeros((2, size), dtype=np.float32)
+        self.spectra = np.full((2, size // 2 + 1), FLOOR)
+        # Frames published, the latest is in buffer published % 2
+        self.published = 0
+        self.overruns = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        # Fixed rate, skipping ahead rather than catching up if it falls
+        # behind
+        due = time.perf_counter()
+        while self.running:
+            self.analyze()
+            due += self.period
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                due = time.perf_counter()
+
+    def analyze(self):
+        # Computes and publishes one frame, False if the ring had too little
+        # audio or was overwritten mid read
+        index = (self.published + 1) % 2
+        wave = self.waves[index]
+        if self.ring.latest(wave) < 0:
+            if self.ring.written >= self.size:
+                self.overruns += 1
+            return False
+        np.multiply(wave, self.window, out=self.frame)
+        if RFFT_OUT:
+            bins = np.fft.rfft(self.frame, out=self.bins)
+        else:
+            bins = np.fft.rfft(self.frame)
+        spectrum = self.spectra[index]
+        np.abs(bins, out=spectrum)
+        spectrum *= self.scale
+        np.maximum(spectrum, 10 ** (FLOOR / 20), out=spectrum)
+        np.log10(spectrum, out=spectrum)
+        spectrum *= 20
+        self.published += 1
+        return True
+
+    def latest(self):
+        # (frame number, waveform, spectrum in dB) of the newest frame. The
+        # arrays are views, left alone until the next frame is published.
+        index = self.published % 2
+        return self.published, self.waves[index], self.spectra[index]
+
+
+def min_max(samples, columns, out=None):
+    # Shrinks samples to 2 * columns points, the lowest then the highest
+    # sample of each column, so a drawn line still reaches every peak
+    per = len(samples) // columns
+    blocks = samples[:per * columns].reshape(columns, per)
+    if out is None:
+        out = np.empty(2 * columns, dtype=samples.dtype)
+    pairs = out.reshape(columns, 2)
+    np.min(blocks, axis=1, out=pairs[:, 0])
+    np.max(blocks, axis=1, out=pairs[:, 1])
+    return out
+
+
+def log_bands(freqs, count, low=20.0):
+    # Start index of count log spaced bands from low up to the last
+    # frequency, dropping bands too narrow to hold a bin of their own
+    edges = np.geomspace(low, freqs[-1], count + 1)[:-1]
+    return np.unique(np.searchsorted(freqs, edges))
+
+
+def band_peaks(spectrum, starts, out=None):
+    # Loudest bin of each band from log_bands
+    return np.maximum.reduceat(spectrum, starts, out=out)
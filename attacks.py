@@ -0,0 +1,184 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Frames of each note's start kept, and how often along them the voice's
+# state is saved so a note can go live partway through
+ATTACK_FRAMES = 4096
+SNAPSHOT_FRAMES = 256
+# Bytes of samples and state the cache may hold
+BUDGET = 16 << 20
+
+
+class VoiceState:
+    # Everything rendering changes in a Synth: operator phases, feedback
+    # and envelopes, and the decimation filter
+    def __init__(self, voice):
+        ops = voice.ops
+        self.phase = [op.phase for op in ops]
+        self.feedback = np.array([op.feedback for op in ops])
+        self.cur = [op.envelope.cur for op in ops]
+        self.stage = [op.envelope.stage for op in ops]
+        self.oversample = voice.oversample
+        self.history = voice.history.copy()
+
+    def restore(self, voice):
+        for i, op in enumerate(voice.ops):
+            op.phase = self.phase[i]
+            op.feedback[:] = self.feedback[i]
+            op.envelope.cur = self.cur[i]
+            op.envelope.stage = self.stage[i]
+        voice.oversample = self.oversample
+        voice.history[:] = self.history
+
+    def nbytes(self):
+        return self.feedback.nbytes + self.history.nbytes
+
+
+class Attack:
+    # The start of one note at unit volume, with the voice's state every
+    # SNAPSHOT_FRAMES frames along it (the first before any were rendered)
+    def __init__(self, key, samples, states):
+        self.key = key
+        self.samples = samples
+        self.states = states
+        self.nbytes = samples.nbytes + sum(state.nbytes() for state in states)
+
+    def resume(self, voice, pos):
+        # Puts voice in the state it has pos frames in, returns how many
+        # frames past the nearest saved state it still has to render
+        snap = min(pos // SNAPSHOT_FRAMES, len(self.states) - 1)
+        self.states[snap].restore(voice)
+        return pos - snap * SNAPSHOT_FRAMES
+
+
+class Recording:
+    # A note start being cached while its voice plays it. The voice hands
+    # over every block it renders live, cut so blocks end on the snapshot
+    # frames, and once frames have been kept the Attack goes into the cache.
+    # Given an Attack cached short it carries on from the end of that.
+    def __init__(self, cache, key, voice, attack=None):
+        self.cache = cache
+        self.key = key
+        self.samples = np.empty(cache.frames, dtype=voice.dtype)
+        if attack is None:
+            self.states = [VoiceState(voice)]
+            self.pos = 0
+        else:
+            self.pos = len(attack.samples)
+            self.samples[:self.pos] = attack.samples
+            self.states = list(attack.states)
+
+    def room(self):
+        # Frames the voice may render before the next snapshot is due
+        return SNAPSHOT_FRAMES - self.pos % SNAPSHOT_FRAMES
+
+    def keep(self, voice, samples):
+        # samples are the voice's unit volume output, its state as they
+        # leave it. Returns True once the recording is complete.
+        end = self.pos + len(samples)
+        self.samples[self.pos:end] = samples
+        self.pos = end
+        if end % SNAPSHOT_FRAMES == 0:
+            self.states.append(VoiceState(voice))
+        if end < len(self.samples):
+            return False
+        self.cache.store(self.key, Attack(self.key, self.samples, self.states))
+        return True
+
+    def stop(self):
+        # Ends the recording early, for a note changed or let go before its
+        # start was complete. What it has up to the last saved state is
+        # still cached, and the next note to play all of it records on.
+        frames = (len(self.states) - 1) * SNAPSHOT_FRAMES
+        if frames:
+            self.cache.store(self.key, Attack(self.key, self.samples[:frames].copy(),
+                                              self.states))
+
+
+class AttackCache:
+    # Rendered note starts shared by a VoicePool's voices. A note restarts
+    # every phase and envelope, so its first frames depend only on the
+    # patch and the frequency; volume is a gain on top and isn't part of
+    # the key. The key is read off the voice as it starts, so any change
+    # to an operator or envelope setting makes a new entry and the old one
+    # is never played again, it just ages out. Least recently used entries
+    # go first once the budget is reached. Voices on render threads look
+    # up and store at the same time, so the entries and counters are only
+    # touched under the lock.
+    def __init__(self, budget=BUDGET, frames=ATTACK_FRAMES):
+        self.budget = budget
+        self.frames = frames - frames % SNAPSHOT_FRAMES
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, voice):
+        # The Attack for a voice that has just been pressed. On a miss the
+        # voice is left recording its note start as it plays it, nothing is
+        # rendered here.
+        key = attack_key(voice)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        voice.recording = Recording(self, key, voice)
+        return None
+
+    def extend(self, voice, attack):
+        # A Recording carrying on from attack, for a voice that has just
+        # played all of it, or None if attack is the full length
+        if len(attack.samples) >= self.frames:
+            return None
+        return Recording(self, attack.key, voice, attack)
+
+    def store(self, key, entry):
+        # Another voice may have recorded as much of the same note start
+        # first, a shorter entry is replaced
+        if entry.nbytes > self.budget:
+            return
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None:
+                if len(old.samples) >= len(entry.samples):
+                    return
+                del self.entries[key]
+                self.nbytes -= old.nbytes
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.budget and self.entries:
+                self.evict()
+
+    def evict(self):
+        # Called with the lock held
+        key, entry = self.entries.popitem(last=False)
+        self.nbytes -= entry.nbytes
+        self.evictions += 1
+
+    def clear(self):
+        # For changes the key can't see, like redefining an algorithm
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self.entries), 'bytes': self.nbytes}
+
+
+def attack_key(voice):
+    # Every setting of a just pressed voice that its output depends on
+    ops = voice.used_ops()
+    return (voice.algorithm, voice.dtype, voice.oversample, voice.max_oversample,
+            tuple(op.frequency for op in ops), tuple(op.mod for op in ops),
+            tuple(op.envelope.timings for op in ops), tuple(op.envelope.s for op in ops),
+            tuple(op.oscillator for op in ops))
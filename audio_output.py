@@ -0,0 +1,25 @@
+import pyaudio
+
+STREAM_FORMATS = {'int16': pyaudio.paInt16, 'float32': pyaudio.paFloat32}
+
+
+class AudioOutput:
+    # Plays an Engine through PortAudio, the stream's callback asking the
+    # engine for each block
+    def __init__(self, engine, rate, fmt='int16'):
+        self.engine = engine
+        self.p = pyaudio.PyAudio()
+        self.stream = self.p.open(format=STREAM_FORMATS[fmt],
+                                  channels=1,
+                                  rate=rate,
+                                  output=True,
+                                  stream_callback=self.callback)
+        self.stream.start_stream()
+
+    def callback(self, in_data, frame_count, time_info, status):
+        return self.engine.render(frame_count, status), pyaudio.paContinue
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.p.terminate()
@@ -0,0 +1,308 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import psop
+from voices import VoicePool
+from mixer import MixBus
+from oversample import FACTORS
+from workers import RenderPool
+
+BLOCK_SIZES = (64, 256, 1024, 4096)
+VOICE_COUNTS = (1, 8, 32)
+THREAD_COUNTS = (1, 2, 4)
+FEEDBACK = (0.0, 2.0, 6.0)
+# Slowdown, as a fraction, that compare() reports as a regression
+THRESHOLD = 0.10
+# Code timed from a fresh interpreter. 'python' alone is the floor the
+# others include.
+STARTUP = {'python': 'pass',
+           'engine': 'import engine; engine.Engine().render(1024)',
+           'pysynth': 'import pysynth'}
+# Worst float32 error, in dB relative to full scale, that check_precision()
+# accepts against the same voice rendered in float64
+PRECISION_TOLERANCE = -80.0
+
+
+def measure(func, min_time=0.2, repeat=5):
+    # Fastest seconds per call over repeat runs. The minimum is the least
+    # disturbed by other load on the machine.
+    func()
+    runs = []
+    for r in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time / repeat:
+                break
+        runs.append(elapsed / calls)
+    return float(min(runs))
+
+
+def held_voice(algorithm, feedback=0.0, freq=440.0, dtype=psop.DTYPE):
+    # A voice in its sustain stage so every call renders the same work
+    voice = psop.Synth(dtype)
+    voice.algorithm = algorithm
+    voice.trigger(freq, 100 * 128)
+    for op in voice.ops:
+        op.mod = 1.0
+    voice.ops[0].mod = feedback
+    return voice
+
+
+def held_pool(count, algorithm=1):
+    pool = VoicePool(max(count, 1))
+    for i in range(count):
+        voice = pool.note_on(48 + i)
+        voice.algorithm = algorithm
+        voice.trigger(110 * 2 ** (i / 12), 100 * 128)
+    pool.render(64)
+    return pool
+
+
+def bench_algorithms(sizes, feedback):
+    results = {}
+    for index in psop.alg:
+        for size in sizes:
+            for fb in feedback:
+                voice = held_voice(index, fb)
+                results[f'alg/{index}/block{size}/fb{fb:g}'] = measure(lambda: voice.get_samples(size))
+    return results
+
+
+def bench_envelope(sizes):
+    results = {}
+    for size in sizes:
+        env = psop.ADSR()
+        env.stage = 1
+
+        def run():
+            # Restart every call so each block crosses stage changes
+            env.stage = 1
+            env.cur = 0
+            env.get_vols(size)
+        results[f'adsr/block{size}'] = measure(run)
+    return results
+
+
+def bench_feedback(sizes, counts):
+    # Voice pools where every voice's feedback operator is in use
+    results = {}
+    for size in sizes:
+        for count in counts:
+            pool = held_pool(count)
+            for i in pool.active:
+                pool.voices[i].ops[0].mod = 2.0
+            results[f'feedback/block{size}/voices{count}'] = measure(lambda: pool.render(size))
+    return results
+
+
+def bench_oversample(sizes):
+    # One wide band voice forced to each oversampling factor
+    results = {}
+    for size in sizes:
+        for factor in FACTORS:
+            voice = held_voice(1, 2.0, 1000.0)
+            for op in voice.ops[1:]:
+                op.mod = 3.0
+            voice.max_oversample = factor
+            results[f'oversample/block{size}/x{factor}'] = measure(lambda: voice.get_samples(size))
+    return results
+
+
+def bench_mix(sizes, counts):
+    results = {}
+    for size in sizes:
+        for count in counts:
+            pool = held_pool(count)
+            bus = MixBus(size, 3)
+
+            def run():
+                pool.render(size, 1, None, bus.begin(size))
+                bus.finish(size)
+            results[f'mix/block{size}/voices{count}'] = measure(run)
+    return results
+
+
+def bench_threads(sizes, count, threads):
+    # One audio callback's worth of a RenderPool, waiting for the workers
+    # every time, for the largest voice count only. With ahead 1 a block
+    # is due one call after its launch, so this times a full render.
+    results = {}
+    for size in sizes:
+        for workers in threads:
+            pool = held_pool(count)
+            render = RenderPool(pool, workers, 1, size)
+            out = np.zeros(size, dtype=np.float32)
+
+            def run():
+                if render.idle() and render.ready():
+                    render.launch(size)
+                render.play(out)
+            results[f'threads/block{size}/voices{count}/t{workers}'] = measure(run)
+            render.close()
+    return results
+
+
+def bench_startup(runs=5):
+    # Fastest of runs fresh interpreters for each STARTUP snippet. pysynth
+    # must import without PyQt5, PyAudio or mido loading.
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, code in STARTUP.items():
+        times = []
+        for r in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=here, check=True)
+            times.append(time.perf_counter() - start)
+        results[f'startup/{name}'] = min(times)
+    return results
+
+
+def run_all(quick=False):
+    sizes = BLOCK_SIZES[1:3] if quick else BLOCK_SIZES
+    counts = VOICE_COUNTS[:2] if quick else VOICE_COUNTS
+    results = {}
+    results.update(bench_algorithms(sizes, FEEDBACK))
+    results.update(bench_envelope(sizes))
+    results.update(bench_feedback(sizes, counts))
+    results.update(bench_oversample(sizes))
+    results.update(bench_mix(sizes, counts))
+    results.update(bench_threads(sizes, counts[-1], THREAD_COUNTS))
+    results.update(bench_startup())
+    return {'python': sys.version.split()[0], 'numpy': np.__version__,
+            'machine': platform.machine(), 'results': results}
+
+
+def precision_error(algorithm, oscillator='exact', feedback=0.0, size=1 << 15):
+    # Renders the same note in float32 and in float64 and returns the error
+    # energy of the float32 one, in dB relative to a full scale sine
+    out = []
+    for dtype in (np.float32, np.float64):
+        voice = held_voice(algorithm, feedback, dtype=dtype)
+        voice.set_oscillator(oscillator)
+        out.append(voice.get_samples(size).astype(np.float64))
+    err = np.mean((out[0] - out[1]) ** 2) / (32768 ** 2 / 2)
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(err)
+
+
+def check_precision(tolerance=PRECISION_TOLERANCE):
+    # Returns [(name, dB)] of every algorithm and backend whose float32
+    # render is further from float64 than tolerance
+    failed = []
+    for index in psop.alg:
+        for oscillator in ('exact', 'table'):
+            for fb in FEEDBACK[:2]:
+                error = precision_error(index, oscillator, fb)
+                name = f'alg/{index}/{oscillator}/fb{fb:g}'
+                print(f"{name:<24}{error:>8.1f} dB")
+                if error > tolerance:
+                    failed.append((name, error))
+    return failed
+
+
+def check_stability(seconds=5, seed=0):
+    # Feedback must stay bounded and carry over block boundaries exactly at
+    # any feedback amount. Returns a list of failure descriptions.
+    failed = []
+    rng = np.random.default_rng(seed)
+    frames = seconds * psop.SAMPLERATE
+    for fb in (0.5, 1.0, 2.0, 4.0, 8.0, -8.0):
+        for freq in (27.5, 440.0, 4186.0):
+            # Without oversampling, whose filter may ring past full scale
+            voice = held_voice(8, fb, freq)
+            voice.max_oversample = 1
+            whole = voice.get_samples(frames)
+            voice = held_voice(8, fb, freq)
+            voice.max_oversample = 1
+            cuts = np.sort(rng.integers(1, frames, 64))
+            split = np.concatenate([voice.get_samples(end - start) for start, end in
+                                    zip(np.r_[0, cuts], np.r_[cuts, frames])])
+            name = f'fb{fb:g}/{freq:g}Hz'
+            if not np.isfinite(whole).all() or np.abs(whole).max() > voice.vol:
+                failed.append(f'{name}: output out of range')
+            # Past about 2 the loop is chaotic and rounding differences grow,
+            # so only the bound is checked there
+            if abs(fb) <= 2 and np.abs(whole - split).max() > 1e-6 * voice.vol:
+                failed.append(f'{name}: block size changes the output')
+    pool = held_pool(psop.FEEDBACK_ROWS + 1)
+    for i in pool.active:
+        pool.voices[i].ops[0].mod = 1.5
+    single = [copy.deepcopy(pool.voices[i]) for i in pool.active]
+    mixed = pool.render(4096)
+    alone = sum(voice.get_samples(4096) for voice in single)
+    # The pool mixes in float32
+    if np.abs(mixed - alone).max() > 1e-6 * np.abs(alone).max():
+        failed.append('batched feedback differs from single voices')
+    return failed
+
+
+def compare(base, new, threshold=THRESHOLD):
+    # Returns [(name, base seconds, new seconds, ratio)] of every benchmark
+    # that got slower than base by more than threshold
+    slower = []
+    for name, old in base['results'].items():
+        cur = new['results'].get(name)
+        if cur is not None and cur > old * (1 + threshold):
+            slower.append((name, old, cur, cur / old))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the psop DSP hot path.')
+    parser.add_argument('--out', help='write the results as JSON to this file')
+    parser.add_argument('--quick', action='store_true', help='fewer block sizes and voice counts')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--precision', action='store_true',
+                        help='check float32 rendering against float64 instead of timing')
+    parser.add_argument('--stability', action='store_true',
+                        help='check operator feedback stays bounded and block independent')
+    args = parser.parse_args()
+
+    if args.stability:
+        failed = check_stability()
+        for failure in failed:
+            print(f"UNSTABLE {failure}")
+        print(f"{len(failed)} feedback checks failed")
+        sys.exit(1 if failed else 0)
+
+    if args.precision:
+        failed = check_precision()
+        for name, error in failed:
+            print(f"TOO NOISY {name}: {error:.1f} dB, tolerance {PRECISION_TOLERANCE:.0f} dB")
+        sys.exit(1 if failed else 0)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        slower = compare(base, new, args.threshold)
+        for name, old, cur, ratio in slower:
+            print(f"SLOWER {name}: {old * 1e6:.1f} us -> {cur * 1e6:.1f} us ({ratio:.2f}x)")
+        print(f"{len(slower)} of {len(base['results'])} benchmarks slower by more than "
+              f"{args.threshold:.0%}")
+        sys.exit(1 if slower else 0)
+
+    result = run_all(args.quick)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+import math
+import numpy as np
+
+
+class Scratch:
+    # Working arrays kept from block to block by name. Each name is one flat
+    # buffer that grows to the largest size asked for and is handed out as
+    # a view of the shape wanted, so once every block size has been seen
+    # rendering allocates nothing. Not shared between threads: every voice
+    # and every VoiceBank has its own.
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        size = math.prod(shape)
+        buf = self.buffers.get((name, dtype))
+        if buf is None or len(buf) < size:
+            buf = self.buffers[(name, dtype)] = np.empty(size, dtype=dtype)
+        return buf[:size].reshape(shape)
@@ -0,0 +1,248 @@
+import os
+import time
+from psop import Synth, DTYPE, MAX_OVERSAMPLE, SMOOTHING, load_algorithms, take_stage_times
+from voices import VoicePool, POLYPHONY
+from events import *
+from stats import CallbackStats
+from mixer import MixBus, BLOCK_SIZE
+from preset import Preset, load_presets
+from ringbuffer import SampleRing
+from workers import RenderPool
+from attacks import AttackCache
+from recorder import Recorder
+
+
+class Engine:
+    # The synth with no devices attached: voices, presets, the event
+    # queues and the mix. Needs nothing but NumPy, so it runs headless and
+    # starts fast; pysynth.PySynth plugs audio, MIDI, the analyzer and the
+    # GUI into it. render() produces each block, called by whatever clocks
+    # the engine, usually the audio callback.
+    def __init__(self, rate=48000, block_size=BLOCK_SIZE, polyphony=POLYPHONY, headroom=3,
+                 clip='hard', dtype=DTYPE, fmt='int16', stage_timing=False,
+                 oversample=MAX_OVERSAMPLE, threads=0, ahead=1, algorithm_file=None,
+                 preset_file=None, attack_cache=0, smoothing=SMOOTHING):
+        if algorithm_file and os.path.exists(algorithm_file):
+            load_algorithms(algorithm_file)
+        self.rate = rate
+
+        # Rendered note starts up to attack_cache bytes, 0 for none
+        self.attacks = AttackCache(attack_cache) if attack_cache else None
+        self.voices = VoicePool(polyphony, dtype=dtype, cache=self.attacks)
+        self.instrument = self.voices.voices
+        for voice in self.instrument:
+            voice.max_oversample = oversample
+            voice.smoothing = smoothing
+        self.bus = MixBus(block_size, headroom, clip, fmt)
+        self.buffer = self.bus.output
+
+        # VARIABLES:
+        self.cur = self.instrument[0]
+        self.cur_note = 0
+        self.cur_freq = 0
+        self.cur_vol = 0
+        self.cur_pitch = 1
+        self.semi_shift = 0
+        self.global_vol = 128
+        # Patch new notes start with. Sounding notes keep the one they
+        # started with, so switching is one assignment on the audio thread.
+        self.presets = [Preset()]
+        if preset_file and os.path.exists(preset_file):
+            self.presets += load_presets(preset_file)
+        self.preset = self.presets[0]
+
+        # MIDI and the GUI never touch the voices themselves, they queue
+        # events that the audio thread applies at the start of each block.
+        # One queue per producer thread (each MIDI port has its own) keeps
+        # both sides lock-free.
+        self.gui_events = EventQueue()
+        self.queues = [self.gui_events]
+        self.last_callback = time.perf_counter()
+        # Render voices on threads worker threads, ahead blocks before they
+        # play, leaving render() only the mixing
+        self.pool = None
+        if threads:
+            self.pool = RenderPool(self.voices, threads, ahead, block_size)
+        # What stopped the pool, if a worker failed and rendering went back
+        # to the audio thread
+        self.pool_error = None
+        self.stats = CallbackStats(voices=polyphony)
+        # Only this engine's voices and banks are timed
+        if stage_timing:
+            self.voices.time_stages()
+            if self.pool is not None:
+                self.pool.time_stages()
+
+        # Copy of the output for the analyzer and anything else that wants
+        # to look at it, written by render() only
+        self.ring = SampleRing()
+        self.full_scale = 1 if fmt == 'float32' else 32768
+        self.recorder = None
+
+    def add_queue(self, queue):
+        # Another producer's EventQueue, set up before rendering starts
+        self.queues.append(queue)
+
+    def render(self, frame_count, status=0):
+        # The next block in the output format. status is the audio
+        # backend's xrun flags for it, if any.
+        now = time.perf_counter()
+        row = self.stats.begin()
+        mix = self.bus.begin(frame_count)
+        if self.pool is not None:
+            # Events go into the next block launched, which plays ahead
+            # blocks from now. If the workers are still busy with it they
+            # wait for the next call.
+            launch = (self.pool.idle(self.stats.alg_times[row], self.stats.voice_times[row],
+                                     self.stats.stage_times[row])
+                      and self.pool.ready())
+            if self.pool.error() is not None:
+                self.stop_pool()
+        if self.pool is None:
+            self.take_events(now, frame_count)
+            events = time.perf_counter()
+            self.voices.render(frame_count, 1, self.stats.alg_times[row], mix,
+                               self.stats.voice_times[row])
+            take_stage_times(self.stats.stage_times[row])
+        else:
+            if launch:
+                self.take_events(now, frame_count)
+                self.pool.launch(frame_count)
+            events = time.perf_counter()
+            self.pool.play(mix)
+        render = time.perf_counter()
+        self.buffer = self.bus.finish(frame_count)
+        self.ring.write(self.buffer)
+        self.stats.record(row, frame_count / self.rate, status, len(self.voices.active),
+                          now, events, render, time.perf_counter())
+        return self.buffer
+
+    def take_events(self, now, frame_count):
+        # Events are placed at the offset they arrived at during the last
+        # block, which delays them by exactly one block instead of jittering.
+        # They are handed to the voices they affect, which cut their own
+        # render at that offset.
+        while True:
+            queue = self.next_queue()
+            if queue is None:
+                break
+            i = queue.peek()
+            if queue.times[i] >= now:
+                # Arrived while this block is being rendered, leave for the next
+                break
+            offset = int((queue.times[i] - self.last_callback) * self.rate)
+            offset = min(max(offset, 0), frame_count - 1)
+            self.apply_event(*queue.get(i), offset)
+            queue.release()
+        self.last_callback = now
+
+    def next_queue(self):
+        # Whichever queue holds the oldest event, so they merge in time order
+        oldest = None
+        for queue in self.queues:
+            if queue.pending() > 0:
+                if oldest is None or queue.times[queue.peek()] < oldest.times[oldest.peek()]:
+                    oldest = queue
+        return oldest
+
+    def send(self, kind, a=0, b=0):
+        # Called from the GUI thread
+        self.gui_events.push(kind, a, b)
+
+    def apply_event(self, kind, a, b, offset=0):
+        # Runs on the audio thread only. Changes to a sounding voice are
+        # scheduled on it for the given frame of the coming block.
+        if kind == NOTE_ON:
+            self.cur_note = a
+            self.cur = self.voices.note_on(a)
+            self.cur_freq = self.note_freq(self.cur_note)
+            self.cur_vol = b
+            self.cur.schedule(offset, self.cur.start, self.preset, self.cur_freq * self.cur_pitch,
+                              self.cur_vol * self.global_vol)
+        elif kind == NOTE_OFF:
+            self.voices.note_off(a, offset)
+        elif kind == PITCH:
+            # pitch bend - 1 octave range, bends every sounding note
+            self.cur_pitch = 2 ** (a / 8192)
+            for i in self.voices.active:
+                x = self.note_freq(self.voices.notes[i]) * self.cur_pitch
+                self.instrument[i].schedule(offset, self.instrument[i].set_freq, x)
+        elif kind == CONTROL:
+            if a == 7:
+                # volume knob
+                self.global_vol = b
+                self.schedule_current(offset, self.cur.set_vol, self.global_vol * self.cur_vol)
+            elif a == 3:
+                # increase op 0 mult (ff on my keyboard)
+                if b != 0:
+                    temp = 1 + (self.cur.ops[0].freq_mult % 16)
+                    self.cur.set_ratio(0, temp)
+            elif a == 2:
+                # decrease op 0 mult (rw on my keyboard)
+                if b != 0:
+                    temp = (self.cur.ops[0].freq_mult - 1) % 16
+                    self.cur.set_ratio(0, temp)
+            elif a == 1:
+                # feedback amount on op[0] - mod wheel
+                t = (b - 64) / 16
+                self.schedule_current(offset, self.cur.set_mod, t, 0)
+        elif kind == ALGORITHM:
+            self.preset = self.preset.replace(algorithm=a)
+            self.set_sounding(offset, setattr, 'algorithm', a)
+        elif kind == OP_FREQ:
+            self.preset = self.preset.set_op('ratios', a, b)
+            self.set_sounding(offset, Synth.set_ratio, a, b)
+        elif kind == OP_MOD:
+            self.preset = self.preset.set_op('mods', a, b)
+            self.set_sounding(offset, Synth.set_mod, b, a)
+        elif kind == VOLUME:
+            self.global_vol = a
+        elif kind == SEMI_SHIFT:
+            self.semi_shift = a
+        elif kind == PRESET:
+            if a < len(self.presets):
+                self.preset = self.presets[a]
+
+    def schedule_current(self, offset, func, *args):
+        # Only sounding voices render, so their events are the only ones
+        # that get run. Once the latest note has been reaped the change is
+        # dropped, its next note starts from the preset anyway.
+        if any(self.instrument[i] is self.cur for i in self.voices.active):
+            self.cur.schedule(offset, func, *args)
+
+    def set_sounding(self, offset, func, *args):
+        # Edits to the patch reach sounding voices at the offset, idle ones
+        # pick up the edited preset with their next note
+        for i in self.voices.active:
+            voice = self.instrument[i]
+            voice.schedule(offset, func, voice, *args)
+
+    def note_freq(self, note):
+        return self.preset.note_freq(note, self.semi_shift)
+
+    def start_recording(self, path):
+        # Records the output to a WAV file from the next block on, in the
+        # output format. Nothing on the audio thread changes.
+        self.stop_recording()
+        self.recorder = Recorder(self.ring, path, self.rate, self.bus.fmt)
+        self.recorder.start()
+
+    def stop_recording(self):
+        # Returns the finished Recorder, for its length and dropped frames
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.stop()
+            self.recorder = None
+        return recorder
+
+    def stop_pool(self):
+        # Falls back to rendering on the audio thread after a worker failed.
+        # Blocks the pool had rendered but not played are dropped.
+        self.pool_error = self.pool.error()
+        self.pool.close()
+        self.pool = None
+
+    def close(self):
+        self.stop_recording()
+        if self.pool is not None:
+            self.pool.close()
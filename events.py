@@ -0,0 +1,99 @@
+import time
+
+# Event kinds
+NOTE_ON = 1
+NOTE_OFF = 2
+PITCH = 3
+CONTROL = 4
+ALGORITHM = 5
+OP_FREQ = 6
+OP_MOD = 7
+VOLUME = 8
+SEMI_SHIFT = 9
+PRESET = 10
+
+QUEUE_SIZE = 1024
+
+
+class EventQueue:
+    # Fixed size ring of timestamped events with one producer thread and one
+    # consumer thread. The producer only moves head and the consumer only
+    # moves tail, so neither side takes a lock or waits on the other. All
+    # slots are allocated up front; a full queue drops the new event.
+    def __init__(self, size=QUEUE_SIZE):
+        self.size = size
+        self.times = [0.0] * size
+        self.kinds = [0] * size
+        self.a = [0] * size
+        self.b = [0] * size
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+
+    def push(self, kind, a=0, b=0):
+        head = self.head
+        if head - self.tail >= self.size:
+            self.dropped += 1
+            return False
+        i = head % self.size
+        self.times[i] = time.perf_counter()
+        self.kinds[i] = kind
+        self.a[i] = a
+        self.b[i] = b
+        # Publish only once the slot is filled in
+        self.head = head + 1
+        return True
+
+    def pending(self):
+        return self.head - self.tail
+
+    def peek(self):
+        # Slot index of the oldest event, call pending() first. The slot
+        # stays valid until release() hands it back to the producer.
+        return self.tail % self.size
+
+    def get(self, i):
+        # (kind, a, b) of the event in slot i
+        return self.kinds[i], self.a[i], self.b[i]
+
+    def release(self):
+        self.tail += 1
+
+
+class CoalescingQueue(EventQueue):
+    # EventQueue for controller streams. push_latest() events that share a
+    # key (a controller on a channel, say) collapse into one: while one is
+    # still queued, newer ones only replace the values it will deliver, so
+    # a burst between two blocks costs the consumer a single event.
+    def __init__(self, size=QUEUE_SIZE):
+        super().__init__(size)
+        self.keys = [None] * size
+        self.latest = {}
+        self.queued = set()
+        self.coalesced = 0
+
+    def push(self, kind, a=0, b=0, key=None):
+        if self.head - self.tail < self.size:
+            self.keys[self.head % self.size] = key
+        return super().push(kind, a, b)
+
+    def push_latest(self, key, kind, a=0, b=0):
+        self.latest[key] = (a, b)
+        if key in self.queued:
+            self.coalesced += 1
+            return True
+        self.queued.add(key)
+        if not self.push(kind, a, b, key):
+            self.queued.discard(key)
+            return False
+        return True
+
+    def get(self, i):
+        key = self.keys[i]
+        if key is None:
+            return super().get(i)
+        # Unmark before reading, so a value stored after this point queues
+        # a new event rather than getting lost
+        self.queued.discard(key)
+        a, b = self.latest[key]
+        return self.kinds[i], a, b
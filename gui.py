@@ -1,33 +1,22 @@
 from decimal import Decimal, Context, setcontext
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QWidget, QLabel, QDial, QComboBox, QGridLayout, QFrame
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QWidget, QLabel, QDial, QComboBox, QGridLayout, QFrame, QPushButton
 from PyQt5.QtGui import QPixmap
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-import numpy as np
+from events import ALGORITHM, VOLUME, OP_FREQ, OP_MOD, SEMI_SHIFT
+from psop import alg, MAX_OPS
 import time
 
-NUM_INSTRUMENTS = 4
-
 
 class AlgorithmSelector(QComboBox):
     def __init__(self, synth):
         super(AlgorithmSelector, self).__init__()
-        # Enumerating the algorithms manually
-        self.addItem(f"A > B > C > D")
-        self.addItem(f"(A + B) > C > D")
-        self.addItem(f"(A + (B > C)) > D")
-        self.addItem(f"((A > B) + C) > D")
-        self.addItem(f"(A > B) + (C > D)")
-        self.addItem(f"(A > B) + (A > C) + (A > D)")
-        self.addItem(f"(A > B) + C + D")
-        self.addItem(f"A + B + C + D")
-        self.addItem(f"A")
+        # One entry per compiled algorithm, in number order
+        for index in sorted(alg):
+            self.addItem(alg[index].name)
         self.currentIndexChanged.connect(lambda: self.algorithm_change(synth))
 
     def algorithm_change(self, synth):
-        for i in range(0, NUM_INSTRUMENTS):
-            synth.instrument[i].algorithm = self.currentIndex()
+        synth.send(ALGORITHM, self.currentIndex())
 
 
 class VolumeControl(QDial):
@@ -49,7 +38,7 @@ class VolumeControl(QDial):
         self.valueChanged.connect(lambda: self.vol_change(synth))
 
     def vol_change(self, synth):
-        synth.global_vol = self.value()
+        synth.send(VOLUME, self.value())
         self.val_display.setNum(self.value())
 
 
@@ -68,8 +57,7 @@ class OpFreqControl(QDial):
         self.valueChanged.connect(lambda: self.op_freq_change(synth, op))
 
     def op_freq_change(self, synth, op):
-        for i in range(0, NUM_INSTRUMENTS):
-            synth.instrument[i].ops[op].freq_mult = self.value()
+        synth.send(OP_FREQ, op, self.value())
         self.val_display.setNum(self.value())
 
 
@@ -86,8 +74,7 @@ class OpModControl(QDial):
         self.valueChanged.connect(lambda: self.op_mod_change(synth, op))
 
     def op_mod_change(self, synth, op):
-        for i in range(0, NUM_INSTRUMENTS):
-            synth.instrument[i].ops[op].mod = self.value() / 100.0
+        synth.send(OP_MOD, op, self.value() / 100.0)
         self.val_display.setNum(self.value() / 100.0)
 
 
@@ -109,13 +96,33 @@ class PitchControl(QDial):
         self.valueChanged.connect(lambda: self.pitch_change(synth))
 
     def pitch_change(self, synth):
-        synth.semi_shift = self.value()
+        synth.send(SEMI_SHIFT, self.value())
         if self.value() > 0:
             self.val_display.setText("+" + str(self.value()))
         else:
             self.val_display.setNum(self.value())
 
 
+class RecordButton(QPushButton):
+    # Records the output to a new WAV file in the working directory while
+    # it is down
+    def __init__(self, synth):
+        super(RecordButton, self).__init__("Record")
+        self.setCheckable(True)
+        self.toggled.connect(lambda: self.record_change(synth))
+
+    def record_change(self, synth):
+        if self.isChecked():
+            synth.start_recording(time.strftime('pysynth-%Y%m%d-%H%M%S.wav'))
+            self.setText("Stop")
+        else:
+            take = synth.stop_recording()
+            self.setText("Record")
+            if take is not None:
+                print(f"recorded {take.frames / take.rate:.1f} s to {take.path}, "
+                      f"{take.dropped} frames dropped")
+
+
 class GUI(QWidget):
 
     def __init__(self):
@@ -123,8 +130,6 @@ class GUI(QWidget):
         from pysynth import PySynth
         self.synth = PySynth()
 
-        self.line = None
-
         # Window environment variables
         self.title = 'PySynth - Feel the wave'
         self.left = 10
@@ -136,6 +141,9 @@ class GUI(QWidget):
         # Synth labels
         self.synth_label = QLabel("Synth 1")
 
+        # Audio callback load readout
+        self.stats_label = QLabel(self.synth.stats.readout())
+
         # Algorithm selector
         self.alg_a = AlgorithmSelector(self.synth)
 
@@ -145,17 +153,14 @@ class GUI(QWidget):
         # Pitch control dial
         self.pitch_a = PitchControl(self.synth)
 
+        # Output recorder
+        self.record = RecordButton(self.synth)
+
         # Operator frequency control dials
-        self.op_a_freq = OpFreqControl(self.synth, 0)
-        self.op_b_freq = OpFreqControl(self.synth, 1)
-        self.op_c_freq = OpFreqControl(self.synth, 2)
-        self.op_d_freq = OpFreqControl(self.synth, 3)
+        self.op_freq = [OpFreqControl(self.synth, i) for i in range(MAX_OPS)]
 
         # Operator mod control dials
-        self.op_a_mod = OpModControl(self.synth, 0)
-        self.op_b_mod = OpModControl(self.synth, 1)
-        self.op_c_mod = OpModControl(self.synth, 2)
-        self.op_d_mod = OpModControl(self.synth, 3)
+        self.op_mod = [OpModControl(self.synth, i) for i in range(MAX_OPS)]
 
         self.init_gui()
 
@@ -165,15 +170,21 @@ class GUI(QWidget):
 
         layout = QGridLayout()
 
-        # Spectrum analyzer
-        dynamic_canvas = FigureCanvas(Figure(figsize=(5, 3)))
-        dynamic_canvas.setMinimumHeight(300)
-        layout.addWidget(dynamic_canvas, 0, 0, 1, 4)
+        # Spectrum analyzer, if the synth runs one. matplotlib is only
+        # loaded for it.
+        self.scope = None
+        if self.synth.analyzer is not None:
+            from scope import ScopeCanvas
+            self.scope = ScopeCanvas(self.synth)
+            self.scope.setMinimumHeight(300)
+            layout.addWidget(self.scope, 0, 0, 1, MAX_OPS)
+
+        # Load readout, text only so a slow timer is plenty
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update_stats)
+        self.timer.start(500)
 
-        self._dynamic_ax = dynamic_canvas.figure.subplots()
-        self.timer = dynamic_canvas.new_timer(
-            100, [(self.update_canvas, (), {})])
-        self.timer.start()
+        layout.addWidget(self.stats_label, 11, 0, 1, MAX_OPS)
 
         # Synth title
         layout.addWidget(self.synth_label, 1, 0)
@@ -191,8 +202,11 @@ class GUI(QWidget):
         layout.addWidget(self.pitch_a.val_display, 2, 2)
         layout.addWidget(self.pitch_a, 3, 2)
 
+        # Recorder
+        layout.addWidget(self.record, 2, 3)
+
         # Per operator labels
-        for i in range(4):
+        for i in range(MAX_OPS):
             char = "A"
             j = chr(ord(char) + i)
             op_label = QLabel(f"Operator {j}")
@@ -202,32 +216,20 @@ class GUI(QWidget):
             layout.addWidget(op_label, 4, i)
 
         # Per operator frequency controls
-        for i in range(4):
+        for i, dial in enumerate(self.op_freq):
             freq_label = QLabel("Frequency")
             freq_label.setAlignment(Qt.AlignCenter)
             layout.addWidget(freq_label, 5, i)
-        layout.addWidget(self.op_a_freq.val_display, 6, 0)
-        layout.addWidget(self.op_a_freq, 7, 0)
-        layout.addWidget(self.op_b_freq.val_display, 6, 1)
-        layout.addWidget(self.op_b_freq, 7, 1)
-        layout.addWidget(self.op_c_freq.val_display, 6, 2)
-        layout.addWidget(self.op_c_freq, 7, 2)
-        layout.addWidget(self.op_d_freq.val_display, 6, 3)
-        layout.addWidget(self.op_d_freq, 7, 3)
+            layout.addWidget(dial.val_display, 6, i)
+            layout.addWidget(dial, 7, i)
 
         # Per operator mod controls
-        for i in range(4):
+        for i, dial in enumerate(self.op_mod):
             mod_label = QLabel("Mod")
             mod_label.setAlignment(Qt.AlignCenter)
             layout.addWidget(mod_label, 8, i)
-        layout.addWidget(self.op_a_mod.val_display, 9, 0)
-        layout.addWidget(self.op_a_mod, 10, 0)
-        layout.addWidget(self.op_b_mod.val_display, 9, 1)
-        layout.addWidget(self.op_b_mod, 10, 1)
-        layout.addWidget(self.op_c_mod.val_display, 9, 2)
-        layout.addWidget(self.op_c_mod, 10, 2)
-        layout.addWidget(self.op_d_mod.val_display, 9, 3)
-        layout.addWidget(self.op_d_mod, 10, 3)
+            layout.addWidget(dial.val_display, 9, i)
+            layout.addWidget(dial, 10, i)
 
         self.setLayout(layout)
 
@@ -238,12 +240,5 @@ class GUI(QWidget):
         self.synth.shutdown()
         event.accept()
 
-    # Update the canvas
-    def update_canvas(self):
-        x = [i + 1 for i in range(1024)]
-        y = self.synth.buffer
-
-        self._dynamic_ax.clear()
-        self.line = self._dynamic_ax.plot(x, y, '-', lw=1)
-        self._dynamic_ax.set_ylim([-32_768, 32_767])
-        self._dynamic_ax.figure.canvas.draw()
+    def update_stats(self):
+        self.stats_label.setText(self.synth.stats.readout())
@@ -0,0 +1,78 @@
+import mido
+from events import CoalescingQueue, NOTE_ON, NOTE_OFF, PITCH, CONTROL, PRESET
+
+BACKEND = 'mido.backends.rtmidi/LINUX_ALSA'
+# Controllers used as buttons, where every press counts. The rest are
+# collapsed to their latest value between blocks, per channel.
+SWITCHES = frozenset((2, 3, 64, 65, 66, 67))
+
+
+class PortReader:
+    # Turns one port's messages into events on its own queue. mido calls
+    # handle() on the port's thread, so each port needs a reader of its
+    # own to keep every queue single producer.
+    def __init__(self, name):
+        self.name = name
+        self.queue = CoalescingQueue()
+        # Messages of types the synth doesn't use, by type
+        self.ignored = {}
+        self.port = None
+
+    def handle(self, msg):
+        kind = msg.type
+        if kind == 'note_on':
+            if msg.velocity:
+                self.queue.push(NOTE_ON, msg.note, msg.velocity)
+            else:
+                self.queue.push(NOTE_OFF, msg.note)
+        elif kind == 'note_off':
+            self.queue.push(NOTE_OFF, msg.note)
+        elif kind == 'pitchwheel':
+            self.queue.push_latest((PITCH, msg.channel), PITCH, msg.pitch)
+        elif kind == 'control_change':
+            if msg.control in SWITCHES:
+                self.queue.push(CONTROL, msg.control, msg.value)
+            else:
+                self.queue.push_latest((CONTROL, msg.channel, msg.control), CONTROL,
+                                       msg.control, msg.value)
+        elif kind == 'program_change':
+            self.queue.push(PRESET, msg.program)
+        else:
+            self.ignored[kind] = self.ignored.get(kind, 0) + 1
+
+
+class MidiInput:
+    # Every MIDI input the synth listens to. names picks ports by name or
+    # part of one; None opens all of them.
+    def __init__(self, names=None):
+        mido.set_backend(BACKEND)
+        self.readers = []
+        for name in port_names(names):
+            reader = PortReader(name)
+            reader.port = mido.open_input(name, callback=reader.handle)
+            self.readers.append(reader)
+        self.queues = [reader.queue for reader in self.readers]
+
+    def ignored(self):
+        # Ignored message counts by type over all ports
+        counts = {}
+        for reader in self.readers:
+            for kind, count in list(reader.ignored.items()):
+                counts[kind] = counts.get(kind, 0) + count
+        return counts
+
+    def coalesced(self):
+        return sum(queue.coalesced for queue in self.queues)
+
+    def close(self):
+        for reader in self.readers:
+            if reader.port is not None:
+                reader.port.close()
+
+
+def port_names(names=None):
+    # Available input ports matching any of names
+    available = mido.get_input_names()
+    if names is None:
+        return available
+    return [port for port in available if any(name in port for name in names)]
@@ -0,0 +1,52 @@
+import numpy as np
+
+BLOCK_SIZE = 1024
+
+
+class MixBus:
+    # Sums voice output into one float32 buffer and converts it to int16
+    # once at the end. The buffers are reused every block and only grow if a
+    # block is bigger than any seen before, so once warmed up a block makes
+    # no new arrays.
+    def __init__(self, frames=BLOCK_SIZE, headroom=1, clip='hard', fmt='int16'):
+        self.gain = 1 / headroom
+        # 'hard' saturates at full scale, 'soft' runs a tanh over the mix
+        self.clip = clip
+        # 'int16', or 'float32' to hand the float mix over in [-1, 1] as is
+        self.fmt = fmt
+        self.resize(frames)
+
+    def resize(self, frames):
+        self.frames = frames
+        self.mix = np.zeros(frames, dtype=np.float32)
+        self.output = np.zeros(frames, dtype=np.int16)
+
+    def begin(self, frame_count):
+        # Returns the cleared float buffer to mix the next block into
+        if frame_count > self.frames:
+            self.resize(frame_count)
+        mix = self.mix[:frame_count]
+        mix.fill(0)
+        return mix
+
+    def finish(self, frame_count):
+        # Applies headroom and clipping, returns the block in the output
+        # format. Voices render in int16 scale, so float output is rescaled.
+        mix = self.mix[:frame_count]
+        if self.fmt == 'float32':
+            mix *= self.gain / 32768
+            if self.clip == 'soft':
+                np.tanh(mix, out=mix)
+            else:
+                np.clip(mix, -1, 1, out=mix)
+            return mix
+        mix *= self.gain
+        if self.clip == 'soft':
+            mix *= 1 / 32768
+            np.tanh(mix, out=mix)
+            mix *= 32767
+        else:
+            np.clip(mix, -32768, 32767, out=mix)
+        out = self.output[:frame_count]
+        np.copyto(out, mix, casting='unsafe')
+        return out
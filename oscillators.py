@@ -0,0 +1,109 @@
+import math
+import time
+import numpy as np
+
+TWO_PI = 2 * np.pi
+
+
+class SineTable:
+    # Sine looked up from a precomputed table of 2**bits points per cycle.
+    # The phase wraps with a bit mask, so any phase value can be passed in.
+    def __init__(self, bits=12, interpolate=True):
+        self.size = 1 << bits
+        self.mask = self.size - 1
+        self.scale = self.size / TWO_PI
+        self.interpolate = interpolate
+        # One extra point so interpolation never has to wrap idx + 1
+        self.table = np.sin(TWO_PI * np.arange(self.size + 1) / self.size)
+        # float32 copy so float32 phases come back as float32
+        self.table32 = self.table.astype(np.float32)
+        self.one = None
+
+    def __call__(self, phase, out=None):
+        # Same calling convention as np.sin, phase and out may be one array
+        table = self.table32 if np.result_type(phase) == np.float32 else self.table
+        if not self.interpolate:
+            idx = np.rint(np.multiply(phase, self.scale)).astype(np.intp)
+            idx &= self.mask
+            return np.take(table, idx, out=out)
+        x = np.multiply(phase, self.scale, out=out)
+        i = np.floor(x)
+        x -= i
+        idx = i.astype(np.intp)
+        idx &= self.mask
+        low = table[idx]
+        x *= table[idx + 1] - low
+        x += low
+        return x
+
+    def scalar(self):
+        # The same lookup as a function of one Python float, for loops that
+        # go a frame at a time. The table is turned into a list once.
+        if self.one is None:
+            points, mask, scale = self.table.tolist(), self.mask, self.scale
+            if not self.interpolate:
+                # round() rounds halves to even like np.rint
+                def one(p):
+                    return points[round(p * scale) & mask]
+            else:
+                floor = math.floor
+
+                def one(p):
+                    x = p * scale
+                    i = floor(x)
+                    idx = i & mask
+                    low = points[idx]
+                    return low + (x - i) * (points[idx + 1] - low)
+            self.one = one
+        return self.one
+
+
+# Oscillator backends an Operator can select, from most to least accurate
+OSCILLATORS = {
+    'exact': np.sin,
+    'table': SineTable(12, True),
+    'fast': SineTable(16, False),
+    'draft': SineTable(10, False)
+}
+
+
+def scalar_oscillator(name):
+    # A backend as a function of one Python float, see SineTable.scalar
+    osc = OSCILLATORS[name]
+    return math.sin if osc is np.sin else osc.scalar()
+
+
+def spectral_error(name, freq=440.0, ratio=3.0, mod=2.0, size=1 << 15, rate=48000):
+    # Renders the same two-operator FM tone with the exact sine and with the
+    # named backend and compares their spectra. Returns the error energy and
+    # the worst single error bin, both in dB relative to the exact tone.
+    t = np.arange(size) / rate
+    carrier = TWO_PI * freq * t
+    modulator = TWO_PI * freq * ratio * t
+    ref = np.sin(carrier + mod * np.sin(modulator))
+    osc = OSCILLATORS[name]
+    test = osc(carrier + mod * osc(modulator))
+    window = np.hanning(size)
+    ref_fft = np.abs(np.fft.rfft(ref * window))
+    err_fft = np.abs(np.fft.rfft((test - ref) * window))
+    with np.errstate(divide='ignore'):
+        energy = 10 * np.log10(np.sum(err_fft ** 2) / np.sum(ref_fft ** 2))
+        spur = 20 * np.log10(err_fft.max() / ref_fft.max())
+    return energy, spur
+
+
+def time_backend(name, size=1 << 15, repeat=50):
+    # Average microseconds to evaluate one block of size phases
+    phase = np.random.default_rng(0).uniform(0, 1000, size)
+    osc = OSCILLATORS[name]
+    start = time.perf_counter()
+    for i in range(repeat):
+        osc(phase)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+if __name__ == '__main__':
+    print(f"{'backend':<8}{'error dB':>10}{'spur dB':>10}{'us/block':>10}")
+    for name in OSCILLATORS:
+        energy, spur = spectral_error(name)
+        print(f"{name:<8}{energy:>10.1f}{spur:>10.1f}{time_backend(name):>10.0f}")
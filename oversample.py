@@ -0,0 +1,166 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Oversampling factors a voice can render at
+FACTORS = (1, 2, 4)
+# Each 2x step down is one half band lowpass. The last step has to keep
+# 0-20 kHz and reject everything folding back onto it, the first step of
+# a 4x render only has to clear the band the second one keeps.
+SHARP_TAPS = 63
+WIDE_TAPS = 19
+KAISER_BETA = 7.0
+
+
+def half_band(taps, beta=KAISER_BETA):
+    # Windowed sinc lowpass at a quarter of the input rate, reversed so it
+    # can be dotted straight with a window of input samples
+    n = np.arange(taps) - (taps - 1) / 2
+    h = np.sinc(n / 2) / 2 * np.kaiser(taps, beta)
+    return (h / h.sum())[::-1].copy()
+
+
+SHARP = half_band(SHARP_TAPS)
+WIDE = half_band(WIDE_TAPS)
+# Delay of each stage in frames of its output. The windows start one input
+# in, which makes both whole numbers.
+SHARP_DELAY = (SHARP_TAPS - 3) // 4
+WIDE_DELAY = (WIDE_TAPS - 3) // 4
+# Every voice that may oversample comes out this many frames late, whatever
+# factor it is at: 1x voices go through a delay line to match the 4x path
+# and 2x voices make up the first stage's delay before the second.
+LATENCY = SHARP_DELAY + WIDE_DELAY // 2
+# Frames of its signal a 1x voice keeps, as far back as the filters'
+# memory reaches so they can be seeded from it if it moves up a factor
+LINE = (SHARP_TAPS - 1) // 2 + WIDE_DELAY // 2
+# Filter history a voice keeps between blocks, last stage first
+HISTORY = SHARP_TAPS - 1 + WIDE_TAPS - 1
+
+
+def halve(x, taps, history, work=None, name='halve'):
+    # Lowpass and keep every other sample. history holds the last inputs of
+    # the previous block and is updated in place; x is (..., frames) and
+    # frames must be even. With a buffers.Scratch as work the joined input
+    # and the output are kept there under name.
+    keep = history.shape[-1]
+    frames = x.shape[-1] // 2
+    if work is None:
+        ext = np.concatenate((history, x), axis=-1)
+        out = None
+    else:
+        # Same type concatenate would give, the history is float64
+        dtype = np.result_type(history, x)
+        ext = work.get(name + '_in', x.shape[:-1] + (keep + x.shape[-1],), dtype)
+        ext[..., :keep] = history
+        ext[..., keep:] = x
+        out = work.get(name, x.shape[:-1] + (frames,), dtype)
+    windows = sliding_window_view(ext, len(taps), axis=-1)[..., 1::2, :]
+    history[...] = ext[..., ext.shape[-1] - keep:]
+    return np.matmul(windows, cast(taps, x.dtype), out=out)
+
+
+def delay(x, line, frames, work=None, name='delay'):
+    # x (..., frames) late, line holds the last inputs of the previous block
+    # and is updated in place like halve's history
+    keep = line.shape[-1]
+    dtype = np.result_type(line, x)
+    if work is None:
+        ext = np.concatenate((line, x), axis=-1)
+        out = np.empty(x.shape, dtype)
+    else:
+        ext = work.get(name + '_in', x.shape[:-1] + (keep + x.shape[-1],), dtype)
+        ext[..., :keep] = line
+        ext[..., keep:] = x
+        out = work.get(name, x.shape, dtype)
+    # Copied out, a slice of ext would be strided for a stack of voices
+    out[...] = ext[..., keep - frames:ext.shape[-1] - frames]
+    line[...] = ext[..., ext.shape[-1] - keep:]
+    return out
+
+
+def decimate(x, history, factor, work=None):
+    # Brings a block rendered at factor times the sample rate back down,
+    # LATENCY frames late. history is (..., HISTORY), one row per voice.
+    if factor == 1:
+        return delay(x, history[..., :LINE], LATENCY, work, 'line')
+    first = history[..., SHARP_TAPS - 1:]
+    if factor == 4:
+        x = halve(x, WIDE, first, work, 'wide')
+    else:
+        x = delay(x, first[..., :WIDE_DELAY], WIDE_DELAY, work, 'pad')
+    return halve(x, SHARP, history[..., :SHARP_TAPS - 1], work, 'sharp')
+
+
+def layout(factor):
+    # (part of the history, its rate, how many frames it lags the voice) for
+    # each memory decimate keeps at factor
+    sharp = (slice(0, SHARP_TAPS - 1), 2, WIDE_DELAY / 2)
+    if factor == 1:
+        return [(slice(0, LINE), 1, 0)]
+    if factor == 2:
+        return [sharp, (slice(SHARP_TAPS - 1, SHARP_TAPS - 1 + WIDE_DELAY), 2, 0)]
+    return [sharp, (slice(SHARP_TAPS - 1, HISTORY), 4, 0)]
+
+
+def stamps(part, rate, lag):
+    # When each sample in that part was rendered, in frames before the block
+    size = part.stop - part.start
+    return (np.arange(size) - size) / rate - lag
+
+
+def reseed(history, old, new):
+    # Rewrites a voice's history for a change of factor. Every memory of the
+    # new factor is interpolated from the samples the old one kept, so the
+    # filters carry on from the voice's recent signal rather than starting
+    # from silence and the output stays in time.
+    times = np.concatenate([stamps(*part) for part in layout(old)])
+    values = np.concatenate([history[part[0]] for part in layout(old)])
+    order = np.argsort(times, kind='stable')
+    fresh = np.zeros_like(history)
+    for part, rate, lag in layout(new):
+        fresh[part] = np.interp(stamps(part, rate, lag), times[order], values[order])
+    history[:] = fresh
+
+
+def cast(taps, dtype):
+    # taps in the dtype being filtered, converted once
+    key = (id(taps), dtype)
+    converted = _cast.get(key)
+    if converted is None:
+        converted = _cast[key] = taps.astype(dtype)
+    return converted
+
+
+_cast = {}
+
+
+def factor_for(bandwidth, nyquist, current=1, max_factor=FACTORS[-1]):
+    # Smallest factor whose Nyquist clears bandwidth (Hz). A voice only
+    # drops to a lower factor once its bandwidth is a fifth under that
+    # factor's limit, so it doesn't flip between them on every block.
+    for factor in FACTORS:
+        if factor >= max_factor:
+            return max_factor
+        limit = factor * nyquist
+        if factor < current:
+            limit *= 0.8
+        if bandwidth <= limit:
+            return factor
+    return max_factor
+
+
+def response(taps, rate, points=4096):
+    # (frequencies Hz, gain dB) of one filter stage at its input rate
+    gain = np.abs(np.fft.rfft(taps, 2 * points))
+    with np.errstate(divide='ignore'):
+        return np.fft.rfftfreq(2 * points, 1 / rate), 20 * np.log10(gain)
+
+
+if __name__ == '__main__':
+    rate = 48000
+    for name, taps, stage_rate, keep in (('sharp', SHARP, 2 * rate, 20000),
+                                         ('wide', WIDE, 4 * rate, 20000)):
+        freqs, db = response(taps, stage_rate)
+        fold = stage_rate / 2 - keep
+        print(f"{name:<6}{len(taps):>4} taps  passband ripple "
+              f"{np.ptp(db[freqs <= keep]):.3f} dB  "
+              f"stopband {db[freqs >= fold].max():.1f} dB")
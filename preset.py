@@ -0,0 +1,118 @@
+import json
+import struct
+from psop import MAX_OPS, TWO_PI, envelope_timings
+
+MAGIC = b'PSOP'
+VERSION = 1
+# Notes a preset's frequency table reaches past 0-127 for semitone shifts
+NOTE_SHIFT = 24
+DEFAULT_ENVELOPE = (0.1, 0.2, 0.6, 0.5)
+
+HEADER = struct.Struct('<4sHdHB')
+OPERATOR = struct.Struct('<6d')
+
+
+class Preset:
+    # One patch: algorithm, per operator frequency ratio, mod amount and
+    # envelope (attack, decay, sustain, release seconds/level), with
+    # everything a note on needs worked out up front. A preset never
+    # changes after it is made, edits make a new one, so swapping the one
+    # in use is a single assignment and voices may share its tables.
+    def __init__(self, name='init', algorithm=1, ratios=None, mods=None, envelopes=None,
+                 oscillator='exact', tuning=440.0):
+        self.name = name
+        self.algorithm = algorithm
+        self.ratios = tuple(ratios or (1,) * MAX_OPS)
+        self.mods = tuple(mods or (0,) * MAX_OPS)
+        self.envelopes = tuple(tuple(env) for env in envelopes or (DEFAULT_ENVELOPE,) * MAX_OPS)
+        self.oscillator = oscillator
+        self.tuning = tuning
+        if not len(self.ratios) == len(self.mods) == len(self.envelopes) == MAX_OPS:
+            raise ValueError(f"{name}: needs settings for all {MAX_OPS} operators")
+        # Precomputed parts
+        self.omegas = tuple(ratio * TWO_PI for ratio in self.ratios)
+        self.timings = tuple(envelope_timings(a, d, r) for a, d, s, r in self.envelopes)
+        self.sustains = tuple(s for a, d, s, r in self.envelopes)
+        self.freqs = note_table(tuning)
+
+    def note_freq(self, note, shift=0):
+        # Hz of a MIDI note, shifted by whole semitones
+        return self.freqs[note + shift + NOTE_SHIFT]
+
+    def replace(self, **changes):
+        # A copy with some settings changed
+        fields = self.to_dict()
+        fields.update(changes)
+        return Preset(**fields)
+
+    def set_op(self, field, op, value):
+        # A copy with one operator's entry of 'ratios', 'mods' or
+        # 'envelopes' changed
+        values = list(getattr(self, field))
+        values[op] = value
+        return self.replace(**{field: values})
+
+    def to_dict(self):
+        return {'name': self.name, 'algorithm': self.algorithm, 'ratios': list(self.ratios),
+                'mods': list(self.mods), 'envelopes': [list(env) for env in self.envelopes],
+                'oscillator': self.oscillator, 'tuning': self.tuning}
+
+    def to_bytes(self):
+        name = self.name.encode()
+        oscillator = self.oscillator.encode()
+        data = [HEADER.pack(MAGIC, VERSION, self.tuning, self.algorithm, MAX_OPS),
+                bytes([len(name)]), name, bytes([len(oscillator)]), oscillator]
+        for ratio, mod, env in zip(self.ratios, self.mods, self.envelopes):
+            data.append(OPERATOR.pack(ratio, mod, *env))
+        return b''.join(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, tuning, algorithm, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a version 1 preset")
+        pos = HEADER.size
+        name = data[pos + 1:pos + 1 + data[pos]].decode()
+        pos += 1 + data[pos]
+        oscillator = data[pos + 1:pos + 1 + data[pos]].decode()
+        pos += 1 + data[pos]
+        ops = [OPERATOR.unpack_from(data, pos + i * OPERATOR.size) for i in range(count)]
+        return cls(name, algorithm, [op[0] for op in ops], [op[1] for op in ops],
+                   [op[2:] for op in ops], oscillator, tuning)
+
+    def save(self, path):
+        # JSON for .json files, the binary layout otherwise
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2)
+        else:
+            with open(path, 'wb') as f:
+                f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith('.json'):
+            with open(path) as f:
+                return cls(**json.load(f))
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def load_presets(path):
+    # A JSON list of presets, as written by Preset.to_dict
+    with open(path) as f:
+        return [Preset(**fields) for fields in json.load(f)]
+
+
+def note_table(tuning):
+    # Hz of every note from -NOTE_SHIFT to 127 + NOTE_SHIFT, shared by every
+    # preset with the same tuning
+    table = _note_tables.get(tuning)
+    if table is None:
+        table = tuple(tuning * 2 ** ((note - 69) / 12)
+                      for note in range(-NOTE_SHIFT, 128 + NOTE_SHIFT))
+        _note_tables[tuning] = table
+    return table
+
+
+_note_tables = {}
@@ -1,24 +1,106 @@
+import json
 import math
+import threading
+import time
 import numpy as np
+from buffers import Scratch
+from oscillators import OSCILLATORS, TWO_PI, scalar_oscillator
+from oversample import HISTORY, decimate, factor_for, reseed
 
 SAMPLERATE = 48000
+# Default precision of the sample arrays. float32 halves the memory
+# traffic; envelopes and phase accumulators stay float64 either way.
+DTYPE = np.float64
+# Frames per slice when rendering a VoiceBank
+BATCH_FRAMES = 256
+# Voices with feedback from which a VoiceBank steps them together, one
+# frame of every voice per step, rather than running each one on its own
+FEEDBACK_ROWS = 16
+# Frames of a lone feedback voice handled as plain Python floats at a time,
+# few enough that the lists come from Python's small object allocator
+FEEDBACK_CHUNK = 64
+# Highest oversampling factor a voice may pick for itself, 1 turns it off
+MAX_OVERSAMPLE = 4
+# Time constant in seconds of the smoothing on mod, volume and frequency
+# changes, 0 makes them jump at once
+SMOOTHING = 0.005
+# How close to its target, relative to the values involved, a smoothed
+# parameter has to get before it is put there and left alone
+SETTLED = 1e-3
+# Frames between steps of the smoother. A glide runs in straight lines
+# from step to step, counted from where it starts, so its path doesn't
+# depend on how the blocks are cut.
+GLIDE_FRAMES = 64
+
+# Operator stages that can be timed, in the order stage_times() keeps them
+STAGES = ('envelope', 'oscillator')
+# Seconds spent in each stage by the calling thread, render threads each
+# time their own voices
+_stage_clock = threading.local()
+
+
+def stage_times():
+    # This thread's seconds in each of STAGES since take_stage_times()
+    times = getattr(_stage_clock, 'times', None)
+    if times is None:
+        times = _stage_clock.times = np.zeros(len(STAGES))
+    return times
+
+
+def take_stage_times(out):
+    # Adds this thread's stage times into out and starts them over
+    times = stage_times()
+    out += times
+    times.fill(0)
+
+
+def timed(stage):
+    # Adds the wrapped method's run time to the thread's stage_times()
+    index = STAGES.index(stage)
+
+    def wrap(func):
+        def timed_func(*args, **kwargs):
+            start = time.perf_counter()
+            temp = func(*args, **kwargs)
+            stage_times()[index] += time.perf_counter() - start
+            return temp
+        return timed_func
+    return wrap
+
+
+def time_stages(op):
+    # Times an Operator or OperatorBatch from now on. Only the instance is
+    # wrapped, so other voices and engines run the plain methods.
+    op.osc = timed('oscillator')(op.osc)
+    op.feedback_osc = timed('oscillator')(op.feedback_osc)
+    op.envelope.get_vols = timed('envelope')(op.envelope.get_vols)
+
+
+def envelope_timings(a, d, r):
+    # Per sample step of each envelope stage, indexed by stage
+    return (0,
+            1 / ((a * SAMPLERATE) + 1),
+            -1 / ((d * SAMPLERATE) + 1),
+            0,
+            -1 / ((r * SAMPLERATE) + 1))
 
 
 class ADSR:
     def __init__(self, a=0.1, d=0.2, s=0.6, r=0.5):
-        self.timings = {
-                0 : 0,
-                1 : 1 / ((a * SAMPLERATE) + 1),
-                2 : -1 / ((d * SAMPLERATE) + 1),
-                3 : 0,
-                4 : -1 / ((r * SAMPLERATE) + 1)
-                }
+        self.timings = envelope_timings(a, d, r)
         self.s = s
         self.cur = 0
         self.stage = 0
+        # Where segment() marks the frames past a stage change
+        self.flags = np.zeros(0, dtype=bool)
+
+    def use(self, timings, s):
+        # Takes over precomputed envelope_timings, which may be shared
+        self.timings = timings
+        self.s = s
 
     def get_vol(self):
-        temp = self.cur + self.timings.get(self.stage)
+        temp = self.cur + self.timings[self.stage]
         if temp > 0.99:
             temp = 0.99
             self.stage = 2
@@ -31,52 +113,588 @@ class ADSR:
         self.cur = temp
         return temp
 
-    def get_vols(self, num):
-        temp = []
-        for i in range(num):
-            temp.append(self.get_vol())
+    def holding(self):
+        # True in idle and sustain, where the level stays where it is
+        cur = self.cur
+        return (self.timings[self.stage] == 0 and 0 <= cur <= 0.99
+                and not (self.stage == 2 and cur < self.s))
+
+    def get_vols(self, num, out=None):
+        # Fills the block one envelope segment at a time. Each straight
+        # segment is a single cumsum, which adds the step in the same order
+        # get_vol does so the output matches it exactly; the sample where a
+        # stage changes falls back to get_vol.
+        temp = np.empty(num) if out is None else out
+        pos = 0
+        while pos < num:
+            count = self.segment(temp[pos:])
+            if count == 0:
+                temp[pos] = self.get_vol()
+                count = 1
+            pos += count
         return temp
 
+    def segment(self, out):
+        # Writes samples of the current stage into out until the next stage
+        # change, returns how many were written
+        step = self.timings[self.stage]
+        size = len(out)
+        if step == 0:
+            # Idle and sustain hold a constant level, nothing to accumulate
+            cur = self.cur
+            if cur > 0.99 or cur < 0 or (self.stage == 2 and cur < self.s):
+                return 0
+            out.fill(cur)
+            return size
+        if step > 0:
+            size = min(size, max(int((0.99 - self.cur) / step), 0) + 2)
+        else:
+            floor = max(self.s, 0) if self.stage == 2 else 0
+            size = min(size, max(int((self.cur - floor) / -step), 0) + 2)
+        # The ramp is built in place, samples past the stage change are
+        # overwritten by whatever comes next
+        ramp = out[:size]
+        ramp.fill(step)
+        ramp[0] += self.cur
+        np.cumsum(ramp, out=ramp)
+        # A rising ramp can only overshoot the top, a falling one can only
+        # drop through the sustain level (decay) or zero (release)
+        if len(self.flags) < size:
+            self.flags = np.zeros(len(out), dtype=bool)
+        bad = self.flags[:size]
+        if step > 0:
+            np.greater(ramp, 0.99, out=bad)
+        else:
+            np.less(ramp, floor, out=bad)
+        count = int(np.argmax(bad))
+        if not bad[count]:
+            count = size
+        # The other limits could only be out from the first sample on
+        first = ramp[0]
+        if first > 0.99 or first < 0 or (self.stage == 2 and first < self.s):
+            count = 0
+        if count > 0:
+            self.cur = ramp[count - 1]
+        return count
+
+
+class ADSRBatch:
+    # Envelopes of many voices, one row per voice. Rows holding a steady
+    # level (idle or sustain), usually most of them, are filled in one go;
+    # the rest run their own ADSR's segments straight into their row, so
+    # they follow exactly the same rules.
+    def __init__(self, capacity):
+        self.all_cur = np.zeros(capacity)
+        self.envelopes = []
+        self.moving = []
+        self.load([])
+
+    def load(self, envelopes):
+        self.envelopes = envelopes
+        self.cur = self.all_cur[:len(envelopes)]
+        self.moving = []
+        for i, env in enumerate(envelopes):
+            self.cur[i] = env.cur
+            if not env.holding():
+                self.moving.append(i)
+
+    def get_vols(self, num, out=None):
+        if out is None:
+            out = np.empty((len(self.envelopes), num))
+        np.copyto(out, self.cur[:, None])
+        for i in self.moving:
+            # The plain method, the batch is timed as a whole
+            ADSR.get_vols(self.envelopes[i], num, out[i])
+        return out
+
 
 class Operator:
-    def __init__(self, i=SAMPLERATE, f=220, m=1):
+    def __init__(self, i=SAMPLERATE, f=220, m=1, dtype=DTYPE):
+        self.dtype = dtype
         self.mod = 0
         self.frequency = f
+        # Values mod and frequency ramp to over the block being rendered
+        # while they glide, None otherwise, and the block's length in
+        # seconds for the frequency ramp
+        self.mod_end = None
+        self.freq_end = None
+        self.span = 0
         self.freq_mult = m
         self.envelope = ADSR()
-        self.feedback = 0
-        self.acc_phase = 0
+        # Last two outputs, fed back into the phase when this is the
+        # algorithm's feedback operator
+        self.feedback = np.zeros(2)
+        # Phase at the start of the next block in radians, kept in [0, 2pi)
+        # so it stays precise however long the note is held
+        self.phase = 0
+        # Sine backend, one of the OSCILLATORS keys
+        self.oscillator = 'exact'
+        # Working arrays, shared with the other operators of the voice
+        self.work = Scratch()
+
+    def osc(self, phase, out=None):
+        return OSCILLATORS[self.oscillator](phase, out)
+
+    def feedback_osc(self, phase, vols, mod):
+        # The feedback recurrence, see samples_fb
+        feedback_row(phase, vols, mod, self.feedback, scalar_oscillator(self.oscillator))
+
+    def block_shape(self, frames):
+        return (frames,)
+
+    def sample(self, t, out=None):
+        # Phase at times t (seconds) after the start of the block. While
+        # the frequency glides it ramps linearly, so the phase picks up a
+        # squared term.
+        temp = np.multiply(t, self.frequency, out=out, dtype=self.dtype)
+        if self.freq_end is not None:
+            bend = np.multiply(t, t, out=self.work.get('bend', t.shape, self.dtype))
+            bend *= (self.freq_end - self.frequency) / (2 * self.span)
+            temp += bend
+        temp += self.phase
+        return temp
+
+    def sample_with(self, in_op, t):
+        return (self.frequency * t) + (self.mod * in_op) + self.phase
+
+    def mod_values(self, size):
+        # mod for each of size frames, just the number unless it glides
+        if self.mod_end is None:
+            return self.mod
+        return ramp(self.mod, self.mod_end, self.work.get('mod_ramp', (size,)))
+
+    def advance(self, size):
+        if self.freq_end is None:
+            self.phase = (self.phase + self.frequency * size / SAMPLERATE) % TWO_PI
+        else:
+            mean = 0.5 * (self.frequency + self.freq_end)
+            self.phase = (self.phase + mean * size / SAMPLERATE) % TWO_PI
+            self.frequency = self.freq_end
+            self.freq_end = None
+        if self.mod_end is not None:
+            self.mod = self.mod_end
+            self.mod_end = None
+
+
+class OperatorBatch:
+    # One operator slot across many voices. Every field is a column so the
+    # sample functions broadcast it against the frame axis.
+    def __init__(self, capacity):
+        self.all_mod = np.zeros((capacity, 1))
+        self.all_frequency = np.zeros((capacity, 1))
+        self.all_phase = np.zeros((capacity, 1))
+        self.all_feedback = np.zeros((capacity, 2))
+        self.envelope = ADSRBatch(capacity)
+        self.oscillator = 'exact'
+        self.dtype = DTYPE
+        self.work = Scratch()
+        self.load([])
 
-    def sample(self, clock):
-        return (self.frequency * clock) + self.acc_phase
+    def load(self, ops):
+        count = len(ops)
+        self.mod = self.all_mod[:count]
+        self.frequency = self.all_frequency[:count]
+        self.phase = self.all_phase[:count]
+        self.feedback = self.all_feedback[:count]
+        self.mod[:, 0] = [op.mod for op in ops]
+        self.frequency[:, 0] = [op.frequency for op in ops]
+        self.phase[:, 0] = [op.phase for op in ops]
+        for row, op in zip(self.feedback, ops):
+            row[:] = op.feedback
+        self.envelope.load([op.envelope for op in ops])
+        # Voices are grouped so that they all use the same backend and dtype
+        if ops:
+            self.oscillator = ops[0].oscillator
+            self.dtype = ops[0].dtype
 
-    def sample_with(self, in_op, clock):
-        return (self.frequency * clock) + (self.mod * in_op) + self.acc_phase
+    def store(self, ops):
+        # The envelopes keep their own state
+        for op, phase, feedback in zip(ops, self.phase[:, 0], self.feedback):
+            op.phase = float(phase)
+            op.feedback[:] = feedback
+
+    def osc(self, phase, out=None):
+        return OSCILLATORS[self.oscillator](phase, out)
+
+    def feedback_osc(self, phase, vols, mod):
+        # The feedback recurrence, see samples_fb. A few voices go one at a
+        # time, those without feedback as plain sines.
+        osc = OSCILLATORS[self.oscillator]
+        if len(phase) >= FEEDBACK_ROWS:
+            feedback_rows(phase, vols, self.mod[:, 0], self.feedback, self.work, osc)
+            return
+        one = scalar_oscillator(self.oscillator)
+        for row, row_vols, row_mod, feedback in zip(phase, vols, self.mod[:, 0], self.feedback):
+            if row_mod:
+                feedback_row(row, row_vols, row_mod, feedback, one)
+            else:
+                osc(row, row)
+                row *= row_vols
+                keep_feedback(row, feedback)
+
+    def block_shape(self, frames):
+        return (len(self.phase), frames)
+
+    def sample(self, t, out=None):
+        # The columns are spread out to whole blocks first, see spread()
+        shape = (len(self.phase), len(t))
+        temp = np.empty(shape, dtype=self.dtype) if out is None else out
+        np.copyto(temp, self.frequency, casting='same_kind')
+        temp *= spread(self.work, 'times', t, shape, self.dtype)
+        temp += spread(self.work, 'phase', self.phase, shape, self.dtype)
+        return temp
+
+    def mod_values(self, size):
+        return self.mod
+
+    def advance(self, size):
+        step = self.work.get('step', self.phase.shape)
+        self.phase += np.multiply(self.frequency, size / SAMPLERATE, out=step)
+        np.mod(self.phase, TWO_PI, out=self.phase)
+
+
+class VoiceBank:
+    # Renders a group of Synth voices that share an algorithm in one pass,
+    # with the voices stacked as rows of a (voices x frames) array. Voices
+    # with parameters still gliding aren't batched, so every value here is
+    # one number per voice.
+    def __init__(self, capacity, num_ops=None):
+        num_ops = num_ops or MAX_OPS
+        self.capacity = capacity
+        self.ops = [OperatorBatch(capacity) for i in range(num_ops)]
+        self.all_vol = np.zeros((capacity, 1))
+        self.all_history = np.zeros((capacity, HISTORY))
+        # Slots, envelopes and filter buffers, shared by the operator slots
+        self.work = Scratch()
+        for batch in self.ops:
+            batch.work = self.work
+
+    def time_stages(self):
+        for batch in self.ops:
+            time_stages(batch)
+
+    def get_samples(self, voices, num_samples, out=None):
+        # Returns one row per voice, already scaled by each voice's volume,
+        # written into out when one is given
+        count = len(voices)
+        func = alg.get(voices[0].algorithm)
+        # Only the operators the algorithm reads
+        batches = self.ops[:func.num_ops]
+        for i, batch in enumerate(batches):
+            batch.load([v.ops[i] for v in voices])
+        vol = self.all_vol[:count]
+        vol[:, 0] = [v.vol for v in voices]
+        # Voices are grouped by oversampling factor as well, and by whether
+        # they may oversample at all, which delays them to line up
+        factor = voices[0].oversample
+        aligned = voices[0].max_oversample > 1
+        if aligned:
+            history = self.all_history[:count]
+            for row, v in zip(history, voices):
+                row[:] = v.history
+        # Long blocks go through in slices so the temporaries stay in cache
+        if out is None:
+            out = np.empty((count, num_samples), dtype=voices[0].dtype)
+        for pos in range(0, num_samples, BATCH_FRAMES):
+            size = min(BATCH_FRAMES, num_samples - pos)
+            temp = func(batches, size, factor)
+            if aligned:
+                temp = decimate(temp, history, factor, self.work)
+            temp *= spread(self.work, 'vol', vol, temp.shape, temp.dtype)
+            np.copyto(out[:, pos:pos + size], temp, casting='same_kind')
+            for batch in batches:
+                batch.advance(size)
+        for i, batch in enumerate(batches):
+            batch.store([v.ops[i] for v in voices])
+        if aligned:
+            for v, row in zip(voices, history):
+                v.history[:] = row
+        return out
 
 
 class Synth:
-    def __init__(self):
-        self.ops = [Operator(), Operator(), Operator(), Operator()]
+    def __init__(self, dtype=DTYPE):
+        self.dtype = dtype
+        self.ops = [Operator(dtype=dtype) for i in range(MAX_OPS)]
+        # Working arrays of every render step, reused from block to block
+        self.work = Scratch()
+        for op in self.ops:
+            op.work = self.work
+        # freq_mult of each operator in radians, what set_freq multiplies by
+        self.ratios = [op.freq_mult * TWO_PI for op in self.ops]
         self.algorithm = 1
-        self.clock = 0
         self.frequency = 220
         self.vol = 0
+        # Value vol ramps to over the block being rendered, if it glides
+        self.vol_end = None
+        # Seconds a mod, volume or frequency change takes to get most of
+        # the way there, and the changes on their way by parameter: 'vol',
+        # 'freq' or an operator's index for its mod
+        self.smoothing = SMOOTHING
+        self.glides = {}
+        # Frames left in the current step of the glides, and by parameter
+        # (value at its end, settled, target it was heading for)
+        self.glide_left = 0
+        self.heading = {}
+        # (offset, function, args) to run during the next get_samples call
+        self.events = []
+        # Oversampling factor in use, and the decimation filter's memory. A
+        # voice that may oversample plays oversample.LATENCY frames late at
+        # every factor, 1 included.
+        self.max_oversample = MAX_OVERSAMPLE
+        self.oversample = 1
+        self.history = np.zeros(HISTORY)
+        # attacks.AttackCache new notes are looked up in, and the cached
+        # Attack being played with the frame reached in it
+        self.cache = None
+        self.attack = None
+        self.attack_pos = 0
+        # attacks.Recording of a note start the cache didn't have, kept as
+        # the voice plays it
+        self.recording = None
 
     def set_freq(self, val):
+        # Glides to the new frequency when smoothing is on
+        if self.smoothing:
+            self.glides['freq'] = val
+        else:
+            self.tune(val)
+
+    def tune(self, val):
+        # Operators carry their own phase, so a new frequency simply takes
+        # over from where the waveform is
         self.frequency = val
-        for i in self.ops:
-            t = val * i.freq_mult * 2 * np.pi
-            i.acc_phase += ((i.frequency - t) * self.clock)
-            i.frequency = t
+        for op, ratio in zip(self.ops, self.ratios):
+            op.frequency = val * ratio
+
+    def set_ratio(self, op, mult):
+        # Takes effect from the next set_freq
+        self.ops[op].freq_mult = mult
+        self.ratios[op] = mult * TWO_PI
 
     def set_mod(self, val, op):
-        self.ops[op].mod = val
+        if self.smoothing:
+            self.glides[op] = val
+        else:
+            self.ops[op].mod = val
+
+    def set_vol(self, val):
+        if self.smoothing:
+            self.glides['vol'] = val
+        else:
+            self.vol = val
+
+    def glide(self, num_samples):
+        # Moves every gliding parameter along over the next num_samples
+        # frames, which stay inside one step, setting the values it ramps
+        # to. Each step follows a one pole smoother and the frames in it
+        # are a straight line to where that gets. A target set partway
+        # through a step is taken up from the next one, and a glide that
+        # has settled is dropped.
+        if not self.glide_left:
+            self.glide_left = GLIDE_FRAMES
+            self.heading = {key: approach(self.glide_value(key), target, GLIDE_FRAMES,
+                                          self.smoothing) + (target,)
+                            for key, target in self.glides.items()}
+        share = num_samples / self.glide_left
+        self.glide_left -= num_samples
+        for key, (value, done, target) in self.heading.items():
+            if self.glide_left:
+                current = self.glide_value(key)
+                value = current + (value - current) * share
+            if key == 'vol':
+                self.vol_end = value
+            elif key == 'freq':
+                self.frequency = value
+                for op, ratio in zip(self.ops, self.ratios):
+                    op.freq_end = value * ratio
+                    op.span = num_samples / SAMPLERATE
+            else:
+                self.ops[key].mod_end = value
+            if not self.glide_left and done and self.glides.get(key) == target:
+                del self.glides[key]
+
+    def glide_value(self, key):
+        # Where a gliding parameter is now
+        if key == 'vol':
+            return self.vol
+        if key == 'freq':
+            return self.frequency
+        return self.ops[key].mod
+
+    def load_preset(self, preset):
+        # Copies a preset's patch onto this voice, the precomputed parts are
+        # shared rather than rebuilt
+        self.algorithm = preset.algorithm
+        self.ratios = list(preset.omegas)
+        for op, mult, mod, timings, s in zip(self.ops, preset.ratios, preset.mods,
+                                             preset.timings, preset.sustains):
+            op.freq_mult = mult
+            op.mod = mod
+            op.envelope.use(timings, s)
+            op.oscillator = preset.oscillator
+
+    def time_stages(self):
+        for op in self.ops:
+            time_stages(op)
+
+    def set_oscillator(self, name):
+        for op in self.ops:
+            op.oscillator = name
+
+    def batch_key(self):
+        # Voices with equal keys can be rendered together by a VoiceBank
+        return ((self.algorithm, self.dtype, self.oversample, self.max_oversample > 1) +
+                tuple(op.oscillator for op in self.used_ops()))
+
+    def choose_oversample(self):
+        # Oversamples only when the estimated bandwidth would fold back
+        # past Nyquist. A change of factor carries the filter's memory over.
+        if self.max_oversample == 1:
+            return 1
+        bandwidth = alg[self.algorithm].bandwidth(self.ops)
+        factor = factor_for(bandwidth, SAMPLERATE / 2, self.oversample, self.max_oversample)
+        if factor != self.oversample:
+            reseed(self.history, self.oversample, factor)
+            self.oversample = factor
+        return factor
+
+    def schedule(self, offset, func, *args):
+        # Calls func(*args) once offset frames of the next block are rendered
+        self.events.append((offset, func, args))
+
+    def get_samples(self, num_samples, events=(), out=None):
+        # Events are (offset, function, args) in time order. The block is cut
+        # at each offset and every piece in between is rendered in one go.
+        # The result goes into out when one is given.
+        if out is None:
+            out = np.empty(num_samples, dtype=self.dtype)
+        pos = 0
+        for offset, func, args in events:
+            offset = min(max(offset, pos), num_samples)
+            if offset > pos:
+                self.render(offset - pos, out[pos:offset])
+                pos = offset
+            if getattr(func, '__func__', None) not in RESTARTS:
+                if self.attack is not None:
+                    self.go_live()
+                # What follows is no longer the plain note start
+                self.stop_recording()
+            func(*args)
+        if pos < num_samples:
+            self.render(num_samples - pos, out[pos:])
+        return out
+
+    def render(self, num_samples, out=None):
+        if self.attack is not None:
+            if not self.glides:
+                return self.play_attack(num_samples, out)
+            self.go_live()
+        if self.glides:
+            self.stop_recording()
+            return self.render_gliding(num_samples, out)
+        if self.recording is not None:
+            return self.render_recorded(num_samples, out)
+        return self.render_live(num_samples, out)
+
+    def render_gliding(self, num_samples, out=None):
+        # Renders live in pieces that end on the glides' steps, carrying on
+        # in one piece once they have all settled
+        if out is None:
+            out = np.empty(num_samples, dtype=self.dtype)
+        pos = 0
+        while pos < num_samples and self.glides:
+            size = min(num_samples - pos, self.glide_left or GLIDE_FRAMES)
+            self.render_live(size, out[pos:pos + size])
+            pos += size
+        if pos < num_samples:
+            self.render_live(num_samples - pos, out[pos:])
+        return out
+
+    def render_recorded(self, num_samples, out=None):
+        # Renders live in pieces that end where the recording saves the
+        # voice's state, carrying on in one piece once it is complete
+        if out is None:
+            out = np.empty(num_samples, dtype=self.dtype)
+        pos = 0
+        while pos < num_samples and self.recording is not None:
+            size = min(num_samples - pos, self.recording.room())
+            self.render_live(size, out[pos:pos + size])
+            pos += size
+        if pos < num_samples:
+            self.render_live(num_samples - pos, out[pos:])
+        return out
 
-    def get_samples(self, num_samples):
+    def play_attack(self, num_samples, out=None):
+        # Plays the cached note start, carrying on live from the state
+        # saved at its end once it runs out
+        if out is None:
+            out = np.empty(num_samples, dtype=self.dtype)
+        samples = self.attack.samples
+        pos = self.attack_pos
+        count = min(num_samples, len(samples) - pos)
+        np.multiply(samples[pos:pos + count], self.vol, out=out[:count])
+        self.attack_pos += count
+        if self.attack_pos == len(samples):
+            attack = self.attack
+            self.go_live()
+            # A note start cached short is recorded on from its end
+            if self.cache is not None:
+                self.recording = self.cache.extend(self, attack)
+            if count < num_samples:
+                self.render(num_samples - count, out[count:])
+        return out
+
+    def go_live(self):
+        # Leaves the cached note start where it has got to, for events
+        # that change the voice. The state is restored from the nearest
+        # snapshot and rendered forward from there.
+        rest = self.attack.resume(self, self.attack_pos)
+        self.attack = None
+        if rest:
+            self.render_live(rest)
+
+    def stop_recording(self):
+        if self.recording is not None:
+            self.recording.stop()
+            self.recording = None
+
+    def render_live(self, num_samples, out=None):
+        if self.glides:
+            self.glide(num_samples)
         func = alg.get(self.algorithm)
-        temp = func(self.ops, self.clock, num_samples)
-        self.clock += num_samples / SAMPLERATE
-        return temp * self.vol
+        factor = self.choose_oversample()
+        temp = func(self.ops, num_samples, factor)
+        if self.max_oversample > 1:
+            temp = decimate(temp, self.history, factor, self.work)
+        for op in self.ops:
+            op.advance(num_samples)
+        if self.recording is not None and self.recording.keep(self, temp):
+            self.recording = None
+        # temp is one of the voice's working arrays, so it is scaled in place
+        # and only then copied out
+        if self.vol_end is None:
+            temp *= self.vol
+        else:
+            vols = ramp(self.vol, self.vol_end, self.work.get('vol_ramp', (num_samples,)))
+            temp *= spread(self.work, 'vols', vols, temp.shape, temp.dtype)
+            self.vol = self.vol_end
+            self.vol_end = None
+        if out is None:
+            return temp.copy()
+        np.copyto(out, temp, casting='same_kind')
+        return out
+
+    def used_ops(self):
+        # The operators the current algorithm plays, the rest sit idle
+        return self.ops[:alg[self.algorithm].num_ops]
+
+    def is_active(self):
+        # A voice is silent once every envelope it plays is back in stage 0
+        return any(op.envelope.stage != 0 for op in self.used_ops())
+
+    def level(self):
+        return self.vol * max(op.envelope.cur for op in self.used_ops())
 
     def release(self):
         for op in self.ops:
@@ -84,106 +702,397 @@ class Synth:
 
     def press(self):
         for op in self.ops:
-            op.feedback = 0
+            op.feedback.fill(0)
             op.envelope.stage = 1
             op.envelope.cur = 0
-            op.acc_phase = 0
-        self.clock = 0
-
-
-def algtest(ops, clock, size):
-    return samples_fb(ops[0], clock, size)
-
-
-def samples(op, clock, size):
-    first = np.sin(np.fromfunction(lambda x: op.sample(clock + (x / SAMPLERATE)), (size,)))
-    vol = op.envelope.get_vols(size)
-    return np.multiply(vol,np.sin(first))
-
-
-def samples_with(op, clock, size, in_op):
-    first = np.fromfunction(lambda x: op.sample(clock + (x / SAMPLERATE)), (size,))
-    vol = op.envelope.get_vols(size)
-    s_in = np.multiply(in_op, op.mod)
-    return np.multiply(vol, np.sin(np.add(first, s_in)))
-
-
-def samples_fb(op, clock, size):
-    first = np.fromfunction(lambda x: op.sample(clock + ((x+1) / SAMPLERATE)), (size,))
-    second = np.sin(np.fromfunction(lambda x: op.sample(clock + (x / SAMPLERATE)), (size,)))
-    vol = op.envelope.get_vols(size)
-    s_in = np.multiply(second, op.mod)
-    output = np.sin(np.add(first, s_in))
-    temp = ((np.abs(op.mod) - 4) / 4)
-    if temp > 0:
-        output -= temp * output
-        output += temp * np.random.normal(scale=1, size=size)
-    return np.multiply(vol, output)
-
-
-def alg1(ops, clock, size):
-    first = samples_fb(ops[0], clock, size)
-    second = samples_with(ops[1], clock, size, first)
-    third = samples_with(ops[2], clock, size, second)
-    return samples_with(ops[3], clock, size, third)
-
-def alg2(ops, clock, size):
-    first = (samples_fb(ops[0], clock, size) + samples(ops[1], clock, size)) / 2
-    second = samples_with(ops[2], clock, size, first)
-    return samples_with(ops[3], clock, size, second)
-
-def alg3(ops, clock, size):
-    first = samples_fb(ops[0], clock, size)
-    second = samples(ops[1], clock, size)
-    third = (first + samples_with(ops[2], clock, size, second)) / 2
-    return samples_with(ops[3], clock, size, third)
-
-#algs 3 and 4 only differ in where the feedback op gets added
-def alg4(ops, clock, size):
-    first = samples_fb(ops[0], clock, size)
-    second = samples(ops[2], clock, size)
-    third = (second + samples_with(ops[1], clock, size, first)) / 2
-    return samples_with(ops[3], clock, size, third)
-
-def alg5(ops, clock, size):
-    first = samples_fb(ops[0], clock, size)
-    second = samples_with(ops[1], clock, size, first)
-    third = samples(ops[2], clock, size)
-    return (second + samples_with(ops[3], clock, size, third)) / 2
-
-def alg6(ops, clock, size):
-    first = samples_fb(ops[0], clock, size)
-    second = samples_with(ops[1], clock, size, first)
-    third = samples_with(ops[2], clock, size, first)
-    fourth = samples_with(ops[3], clock, size, first)
-    return (second + third + fourth) / 3
-
-def alg7(ops, clock, size):
-    first = samples_fb(ops[0], clock, size)
-    second = samples_with(ops[1], clock, size, first)
-    return (second + samples(ops[2], clock, size) + samples(ops[3], clock, size)) / 3
-
-def alg8(ops, clock, size):
-    first = samples_fb(ops[0], clock, size) + samples(ops[1], clock, size)
-    second = samples(ops[2], clock, size) + samples(ops[3], clock, size)
-    return (first + second) / 4
-
-alg = {
-        0 : alg1,
-        1 : alg2,
-        2 : alg3,
-        3 : alg4,
-        4 : alg5,
-        5 : alg6,
-        6 : alg7,
-        7 : alg8,
-        8 : algtest
-}
-
-
-def lerp(startval, endval, time, endtime):
-    if time > endtime:
-        return endval
+            op.phase = 0
+        self.history.fill(0)
+
+    def trigger(self, freq, vol):
+        # Starts a new note, everything a note on does in one call
+        self.attack = None
+        self.stop_recording()
+        self.glides.clear()
+        self.glide_left = 0
+        self.press()
+        self.tune(freq)
+        self.vol = vol
+        if self.cache is not None:
+            # The factor the note starts at is part of its key
+            self.choose_oversample()
+            self.attack = self.cache.lookup(self)
+            self.attack_pos = 0
+
+    def start(self, preset, freq, vol):
+        # Starts a new note with preset's patch
+        self.load_preset(preset)
+        self.trigger(freq, vol)
+
+
+# Voice methods that start a note over, so a cached note start they cut
+# into needn't be brought up to date first
+RESTARTS = (Synth.start, Synth.trigger)
+
+
+def samples(op, size, out=None, factor=1):
+    temp = op.sample(frame_times(size, op.dtype, factor), out)
+    op.osc(temp, temp)
+    temp *= envelope_vols(op, size, factor)
+    return temp
+
+
+def samples_with(op, size, in_op, out=None, factor=1):
+    temp = op.sample(frame_times(size, op.dtype, factor), out)
+    driven = spread(op.work, 'driven', op.mod_values(size * factor), temp.shape, temp.dtype)
+    driven *= in_op
+    temp += driven
+    op.osc(temp, temp)
+    temp *= envelope_vols(op, size, factor)
+    return temp
+
+
+def samples_fb(op, size, out=None, factor=1):
+    # DX style feedback: every frame's phase is pushed along by mod times
+    # the average of the operator's own last two outputs. op.feedback holds
+    # those two outputs from one block to the next.
+    temp = op.sample(frame_times(size, op.dtype, factor), out)
+    vols = envelope_vols(op, size, factor)
+    mod = op.mod_values(size * factor)
+    if not np.count_nonzero(mod):
+        op.osc(temp, temp)
+        temp *= vols
+        keep_feedback(temp, op.feedback)
+    else:
+        op.feedback_osc(temp, vols, mod)
+    return temp
+
+
+def feedback_row(phase, vols, mod, feedback, sin=math.sin):
+    # Runs the feedback recurrence over one voice, overwriting phase with
+    # the output. Each frame needs the one before, so this is a loop, kept
+    # to plain floats where it costs a fraction of a microsecond per frame.
+    # mod is a number, or one per frame while it glides. sin is the
+    # operator's backend for one float, see scalar_oscillator.
+    y1, y2 = float(feedback[0]), float(feedback[1])
+    ramped = np.ndim(mod)
+    half = 0 if ramped else 0.5 * float(mod)
+    for start in range(0, len(phase), FEEDBACK_CHUNK):
+        chunk = slice(start, start + FEEDBACK_CHUNK)
+        out = []
+        append = out.append
+        if ramped:
+            for p, v, m in zip(phase[chunk].tolist(), vols[chunk].tolist(), mod[chunk].tolist()):
+                y = v * sin(p + 0.5 * m * (y1 + y2))
+                append(y)
+                y2 = y1
+                y1 = y
+        else:
+            for p, v in zip(phase[chunk].tolist(), vols[chunk].tolist()):
+                y = v * sin(p + half * (y1 + y2))
+                append(y)
+                y2 = y1
+                y1 = y
+        phase[chunk] = out
+    feedback[0] = y1
+    feedback[1] = y2
+
+
+def feedback_rows(phase, vols, mod, feedback, work, osc=np.sin):
+    # Same recurrence over (voices x frames), one frame of every voice per
+    # step, which beats per voice loops once there are enough voices. Works
+    # on a transposed copy so each frame is one contiguous row. osc is the
+    # operators' backend.
+    count, size = phase.shape
+    half = np.multiply(mod, 0.5, out=work.get('fb_half', (count,)))
+    frames = work.get('fb_frames', (size, count), phase.dtype)
+    np.copyto(frames, phase.T)
+    frame_vols = work.get('fb_vols', (size, count), vols.dtype)
+    np.copyto(frame_vols, vols.T)
+    y1 = work.get('fb_y1', (count,))
+    y1[:] = feedback[:, 0]
+    y2 = work.get('fb_y2', (count,))
+    y2[:] = feedback[:, 1]
+    temp = work.get('fb_temp', (count,))
+    for y, v in zip(frames, frame_vols):
+        np.add(y1, y2, out=temp)
+        temp *= half
+        y += temp
+        osc(y, y)
+        y *= v
+        y1, y2 = y, y1
+    phase[:] = frames.T
+    feedback[:, 0] = y1
+    feedback[:, 1] = y2
+
+
+def envelope_vols(op, size, factor=1):
+    # The envelope runs at the output rate, oversampled frames share its
+    # value. They come back in the operator's dtype, see spread().
+    vols = op.envelope.get_vols(size, op.work.get('vols', op.block_shape(size)))
+    if factor == 1 and vols.dtype == op.dtype:
+        return vols
+    wide = op.work.get('wide_vols', op.block_shape(size * factor), op.dtype)
+    wide.reshape(op.block_shape(size) + (factor,))[...] = vols[..., None]
+    return wide
+
+
+def spread(work, name, value, shape, dtype):
+    # value (a number, a column per voice or a row per frame) copied out to
+    # a whole block in work. NumPy gives every ufunc call that broadcasts or
+    # casts an operand a buffer of its own, copyto needs none, so the
+    # render path does its broadcasting this way and stays allocation free.
+    out = work.get(name, shape, dtype)
+    np.copyto(out, value, casting='same_kind')
+    return out
+
+
+def keep_feedback(output, feedback):
+    # Saves the last two outputs of a block rendered without feedback
+    if output.shape[-1] > 1:
+        feedback[..., 1] = output[..., -2]
     else:
-        temp = (endval - startval) * (time / endtime)
-        return startval + temp
+        feedback[..., 1] = feedback[..., 0]
+    feedback[..., 0] = output[..., -1]
+
+
+# Algorithms as data. 'modulation' lists (source, destination) operator
+# pairs, an operator with several sources is driven by their average, and
+# the output is the average of the 'carriers'. The 'feedback' operator has
+# no sources and uses its mod value as the feedback amount instead.
+ALGORITHMS = [
+    {'name': 'A > B > C > D', 'ops': 4, 'feedback': 0,
+     'modulation': [(0, 1), (1, 2), (2, 3)], 'carriers': [3]},
+    {'name': '(A + B) > C > D', 'ops': 4, 'feedback': 0,
+     'modulation': [(0, 2), (1, 2), (2, 3)], 'carriers': [3]},
+    {'name': '(A + (B > C)) > D', 'ops': 4, 'feedback': 0,
+     'modulation': [(1, 2), (0, 3), (2, 3)], 'carriers': [3]},
+    {'name': '((A > B) + C) > D', 'ops': 4, 'feedback': 0,
+     'modulation': [(0, 1), (1, 3), (2, 3)], 'carriers': [3]},
+    {'name': '(A > B) + (C > D)', 'ops': 4, 'feedback': 0,
+     'modulation': [(0, 1), (2, 3)], 'carriers': [1, 3]},
+    {'name': '(A > B) + (A > C) + (A > D)', 'ops': 4, 'feedback': 0,
+     'modulation': [(0, 1), (0, 2), (0, 3)], 'carriers': [1, 2, 3]},
+    {'name': '(A > B) + C + D', 'ops': 4, 'feedback': 0,
+     'modulation': [(0, 1)], 'carriers': [1, 2, 3]},
+    {'name': 'A + B + C + D', 'ops': 4, 'feedback': 0,
+     'modulation': [], 'carriers': [0, 1, 2, 3]},
+    {'name': 'A', 'ops': 1, 'feedback': 0,
+     'modulation': [], 'carriers': [0]},
+    {'name': '(A > B > C) + (D > E > F)', 'ops': 6, 'feedback': 0,
+     'modulation': [(0, 1), (1, 2), (3, 4), (4, 5)], 'carriers': [2, 5]},
+    {'name': '(A > B) + (C > D) + (E > F)', 'ops': 6, 'feedback': 0,
+     'modulation': [(0, 1), (2, 3), (4, 5)], 'carriers': [1, 3, 5]},
+    {'name': '((A > B) + (C > D > E)) > F', 'ops': 6, 'feedback': 0,
+     'modulation': [(0, 1), (2, 3), (3, 4), (1, 5), (4, 5)], 'carriers': [5]},
+]
+
+# Operators every Synth carries, enough for the largest algorithm
+MAX_OPS = 6
+
+
+class Algorithm:
+    # An algorithm compiled into a fixed list of steps. Every operator and
+    # every average is computed once and shared by all its consumers, and
+    # each result is written into one of a few slots that are handed on to
+    # later steps once nothing reads them any more.
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.num_ops = spec['ops']
+        self.steps, self.num_slots, self.output = compile_algorithm(spec)
+        self.order = [step[1] for step in self.steps if step[0] != 'mix']
+        self.sources = [[src for src, dst in spec['modulation'] if dst == i]
+                        for i in range(self.num_ops)]
+        self.carriers = sorted(set(spec['carriers']))
+        self.feedback = spec.get('feedback')
+
+    def bandwidth(self, ops):
+        # Rough top of the output spectrum in Hz by Carson's rule: an
+        # operator reaches its own frequency plus (index + 1) times the top
+        # of whatever modulates it
+        top = [0.0] * self.num_ops
+        for i in self.order:
+            freq = abs(ops[i].frequency) / TWO_PI
+            index = abs(ops[i].mod)
+            if self.sources[i]:
+                top[i] = freq + (index + 1) * max(top[src] for src in self.sources[i])
+            elif i == self.feedback and index:
+                top[i] = freq + (index + 1) * freq
+            else:
+                top[i] = freq
+        return max(top[i] for i in self.carriers)
+
+    def __call__(self, ops, size, factor=1):
+        # Renders size output frames as size * factor frames at factor
+        # times the sample rate, left for the caller to decimate. The slots
+        # are the operators' working arrays, so nothing new is made.
+        work = ops[0].work
+        shape = ops[0].block_shape(size * factor)
+        slots = [work.get(('slot', i), shape, ops[0].dtype) for i in range(self.num_slots)]
+        for step in self.steps:
+            if step[0] == 'mix':
+                kind, sources, slot = step
+                out = slots[slot]
+                np.add(slots[sources[0]], slots[sources[1]], out=out)
+                for source in sources[2:]:
+                    out += slots[source]
+                np.divide(out, len(sources), out=out)
+            elif step[0] == 'with':
+                kind, index, source, slot = step
+                slots[slot] = samples_with(ops[index], size, slots[source], slots[slot], factor)
+            elif step[0] == 'fb':
+                kind, index, slot = step
+                slots[slot] = samples_fb(ops[index], size, slots[slot], factor)
+            else:
+                kind, index, slot = step
+                slots[slot] = samples(ops[index], size, slots[slot], factor)
+        return slots[self.output]
+
+
+def compile_algorithm(spec):
+    # Returns (steps, slot count, output slot) for one ALGORITHMS entry. Steps are
+    # ('plain' | 'fb', op, slot), ('with', op, input slot, slot) and
+    # ('mix', input slots, slot), run in order.
+    count = spec['ops']
+    if not 1 <= count <= MAX_OPS:
+        raise ValueError(f"{spec['name']}: needs 1 to {MAX_OPS} operators")
+    sources = [[] for i in range(count)]
+    for src, dst in spec['modulation']:
+        if not (0 <= src < count and 0 <= dst < count) or src == dst:
+            raise ValueError(f"{spec['name']}: bad modulation {src} > {dst}")
+        sources[dst].append(src)
+    feedback = spec.get('feedback')
+    if feedback is not None and not 0 <= feedback < count:
+        raise ValueError(f"{spec['name']}: no operator {feedback} for feedback")
+    if feedback is not None and sources[feedback]:
+        raise ValueError(f"{spec['name']}: the feedback operator can't be modulated")
+    carriers = sorted(set(spec['carriers']))
+    if not carriers:
+        raise ValueError(f"{spec['name']}: no carriers")
+
+    # Operators in dependency order, lowest index first among the ready ones
+    order = []
+    done = set()
+    while len(order) < count:
+        ready = [i for i in range(count) if i not in done and done.issuperset(sources[i])]
+        if not ready:
+            raise ValueError(f"{spec['name']}: modulation has a loop")
+        order.append(ready[0])
+        done.add(ready[0])
+
+    # Every value is an operator index or a tuple of the operators averaged
+    # into it. Identical averages become one value.
+    inputs = [tuple(sorted(set(s))) if len(set(s)) > 1 else (s[0] if s else None)
+              for s in sources]
+    output = tuple(carriers) if len(carriers) > 1 else carriers[0]
+    values = []
+    for i in order:
+        if isinstance(inputs[i], tuple) and inputs[i] not in values:
+            values.append(inputs[i])
+        values.append(i)
+    if isinstance(output, tuple) and output not in values:
+        values.append(output)
+    # Position of the last step reading each value
+    last_use = {output: len(values)}
+    for pos, value in enumerate(values):
+        for read in value if isinstance(value, tuple) else [inputs[value]]:
+            if read is not None:
+                last_use[read] = pos
+    unused = [i for i in range(count) if i not in last_use]
+    if unused:
+        raise ValueError(f"{spec['name']}: operators {unused} don't reach a carrier")
+
+    steps = []
+    slot_of = {}
+    free = []
+    num_slots = 0
+    for pos, value in enumerate(values):
+        reads = value if isinstance(value, tuple) else [inputs[value]]
+        dead = [slot_of[read] for read in reads if read is not None and last_use[read] == pos]
+        # An average may be written over its first input, an operator's
+        # output can't share a slot with its input
+        if isinstance(value, tuple) and last_use[value[0]] == pos:
+            free.append(dead.pop(0))
+        if free:
+            slot = free.pop()
+        else:
+            slot = num_slots
+            num_slots += 1
+        slot_of[value] = slot
+        free.extend(dead)
+        if isinstance(value, tuple):
+            steps.append(('mix', tuple(slot_of[i] for i in value), slot))
+        elif inputs[value] is not None:
+            steps.append(('with', value, slot_of[inputs[value]], slot))
+        elif value == feedback:
+            steps.append(('fb', value, slot))
+        else:
+            steps.append(('plain', value, slot))
+    return steps, num_slots, slot_of[output]
+
+
+def register_algorithm(spec):
+    # Compiles spec and adds it under the next free algorithm number
+    index = len(alg)
+    alg[index] = Algorithm(spec)
+    return index
+
+
+def load_algorithms(path):
+    # Adds every algorithm in a JSON file holding a list of ALGORITHMS style
+    # entries, returns their numbers
+    with open(path) as f:
+        return [register_algorithm(spec) for spec in json.load(f)]
+
+
+alg = {}
+for spec in ALGORITHMS:
+    register_algorithm(spec)
+
+
+def frame_times(size, dtype=DTYPE, factor=1):
+    # Time of each frame from the start of the block, cached per block size.
+    # Oversampled blocks have factor frames for every output frame.
+    times = _frame_times.get((size, dtype, factor))
+    if times is None:
+        times = (np.arange(size * factor) / (SAMPLERATE * factor)).astype(dtype)
+        _frame_times[(size, dtype, factor)] = times
+    return times
+
+
+_frame_times = {}
+
+
+def lerp(startval, endval, time, endtime, out=None):
+    # Straight line from startval at time 0 to endval at endtime, held
+    # there after. time can be an array of times, written into out if given.
+    if out is None:
+        return startval + (endval - startval) * np.minimum(np.divide(time, endtime), 1)
+    np.divide(time, endtime, out=out)
+    np.minimum(out, 1, out=out)
+    out *= endval - startval
+    out += startval
+    return out
+
+
+def ramp(startval, endval, out):
+    # Fills out with frames going from startval to endval, reaching it on
+    # the last
+    size = len(out)
+    steps = _ramp_steps.get(size)
+    if steps is None:
+        steps = _ramp_steps[size] = np.arange(1, size + 1) / size
+    return lerp(startval, endval, steps, 1, out)
+
+
+_ramp_steps = {}
+
+
+def approach(current, target, frames, smoothing):
+    # Where a one pole smoother with time constant smoothing (seconds)
+    # gets from current in frames, and whether that counts as there
+    if smoothing <= 0:
+        return target, True
+    value = target + (current - target) * math.exp(-frames / (smoothing * SAMPLERATE))
+    if abs(value - target) <= SETTLED * max(abs(current), abs(target)):
+        return target, True
+    return value, False
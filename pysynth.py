@@ -1,104 +1,95 @@
-from PyQt5.QtCore import QRunnable
-from PyQt5.QtWidgets import QApplication
-from gui import GUI
-from psop import *
-import pyaudio
-import numpy as np
-import mido
 import sys
+import numpy as np
+from engine import Engine
 
-NUM_INSTRUMENTS = 3
 BUFFER_SIZE = 1024
+RATE = 48000
+# Mix divisor, keeps a few full-velocity notes from clipping
+HEADROOM = 3
+# What happens past full scale, 'hard' saturates and 'soft' uses tanh
+CLIP = 'hard'
+# Precision of the voice DSP, and the sample format of the audio stream.
+# A float32 stream skips the int16 quantization step.
+DSP_DTYPE = np.float64
+OUTPUT_FORMAT = 'int16'
+# Also time the envelope and oscillator stages of every operator, which
+# adds a little overhead to each block
+STAGE_TIMING = False
+# Highest factor a voice may oversample by to keep FM sidebands from
+# folding back, 1 turns oversampling off
+OVERSAMPLE = 4
+# Spectrum frames a second computed from the output, 0 for none
+ANALYZER_FPS = 30
+# Extra algorithms to offer, a JSON list in the psop.ALGORITHMS format
+ALGORITHM_FILE = 'algorithms.json'
+# Presets selectable by MIDI program change, a JSON list of Preset.to_dict
+PRESET_FILE = 'presets.json'
+# Render voices on this many worker threads, RENDER_AHEAD blocks before
+# they play, leaving the audio callback only the mixing. Adds RENDER_AHEAD
+# blocks of latency. 0 renders on the audio thread as before.
+RENDER_THREADS = 0
+RENDER_AHEAD = 1
+# Bytes of rendered note starts to keep and replay instead of rendering
+# every note from scratch (16 << 20 is plenty), 0 turns the cache off
+ATTACK_CACHE = 0
+# Seconds over which mod, volume and pitch changes glide rather than step
+# at block boundaries, 0 to let them jump
+SMOOTHING = 0.005
+# MIDI inputs to listen to, by name or part of one. None opens every port.
+MIDI_PORTS = None
 
-class PySynth(QRunnable):
-
-    def __init__(self):
-        super(PySynth, self).__init__()
-
-
-        self.instrument = []
-        for i in range(0, NUM_INSTRUMENTS):
-            self.instrument.append(Synth())
-        self.p = pyaudio.PyAudio()
-        self.buffer = np.empty(BUFFER_SIZE)
-        mido.set_backend('mido.backends.rtmidi/LINUX_ALSA')
-
-        # VARIABLES:
-        self.cur = 0
-        self.cur_keys = [0] * NUM_INSTRUMENTS
-        self.cur_note = 0
-        self.cur_freq = 0
-        self.cur_vol = 0
-        self.cur_pitch = 1
-        self.semi_shift = 0
-        self.global_vol = 128
-
-        self.stream = self.p.open(format=pyaudio.paInt16,
-                                  channels=1,
-                                  rate=48000,
-                                  output=True,
-                                  stream_callback=self.audio_callback)
-        self.stream.start_stream()
 
-        self.inport = mido.open_input(mido.get_input_names()[0],
-                                      callback=self.midi_callback)
+class PySynth(Engine):
+    # The engine with its devices: audio out, MIDI in, the analyzer. Each
+    # one is imported only when it is used, so PySynth(audio=False,
+    # midi=False) starts without PyAudio or mido installed.
+    def __init__(self, audio=True, midi=True, analyzer=ANALYZER_FPS):
+        super(PySynth, self).__init__(RATE, BUFFER_SIZE, headroom=HEADROOM, clip=CLIP,
+                                      dtype=DSP_DTYPE, fmt=OUTPUT_FORMAT,
+                                      stage_timing=STAGE_TIMING, oversample=OVERSAMPLE,
+                                      threads=RENDER_THREADS, ahead=RENDER_AHEAD,
+                                      algorithm_file=ALGORITHM_FILE, preset_file=PRESET_FILE,
+                                      attack_cache=ATTACK_CACHE, smoothing=SMOOTHING)
+        self.analyzer = None
+        if analyzer:
+            from analyzer import Analyzer
+            self.analyzer = Analyzer(self.ring, rate=RATE, fps=analyzer,
+                                     full_scale=self.full_scale)
+            self.analyzer.start()
 
-    def audio_callback(self, in_data, frame_count, time_info, status):
-        self.buffer = np.zeros(frame_count, dtype=np.int16)
-        for i in range(0, NUM_INSTRUMENTS):
-            self.buffer += np.asarray(self.instrument[i].get_samples(frame_count)/NUM_INSTRUMENTS, dtype=np.int16)
-        return self.buffer, pyaudio.paContinue
+        self.audio = None
+        if audio:
+            from audio_output import AudioOutput
+            self.audio = AudioOutput(self, RATE, OUTPUT_FORMAT)
 
-    def midi_callback(self, msg):
-        if msg.type == 'note_on':
-            self.cur_note = msg.note
-            self.instrument[self.cur].press()
-            self.cur_freq = (2 ** (((self.cur_note - 69) + self.semi_shift) / 12)) * 440
-            self.instrument[self.cur].set_freq(self.cur_freq * self.cur_pitch)
-            self.cur_vol = msg.velocity
-            self.instrument[self.cur].vol = self.cur_vol * self.global_vol
-            if self.cur_keys[self.cur] != msg.note:
-                self.cur_keys[self.cur] = msg.note
-                self.cur = (self.cur + 1) % NUM_INSTRUMENTS
-        elif msg.type == 'note_off':
-            for i in range(0, NUM_INSTRUMENTS):
-                if self.cur_keys[i] == msg.note:
-                    self.instrument[i].release()
-        elif msg.type == 'pitchwheel':
-            # pitch bend - 1 octave range
-            self.cur_pitch = 2 ** (msg.pitch / 8192)
-            x = self.cur_freq * self.cur_pitch
-            self.instrument[self.cur].set_freq(x)
-        elif msg.type == 'control_change':
-            if msg.control == 7:
-                # volume knob
-                self.global_vol = msg.value
-                self.instrument[self.cur].vol = self.global_vol * self.cur_vol
-            elif msg.control == 3:
-                # increase op 0 mult (ff on my keyboard)
-                if msg.value != 0:
-                    temp = 1 + (self.instrument[self.cur].ops[0].freq_mult % 16)
-                    self.instrument[self.cur].ops[0].freq_mult = temp
-            elif msg.control == 2:
-                # decrease op 0 mult (rw on my keyboard)
-                if msg.value != 0:
-                    temp = (self.instrument[self.cur].ops[0].freq_mult - 1) % 16
-                    self.instrument[self.cur].ops[0].freq_mult = temp
-            elif msg.control == 1:
-                # feedback amount on op[0] - mod wheel
-                t = (msg.value - 64) / 16
-                self.instrument[self.cur].set_mod(t, 0)
-        else:
-            print(msg)
+        self.midi = None
+        if midi:
+            from midi_input import MidiInput
+            self.midi = MidiInput(MIDI_PORTS)
+            for queue in self.midi.queues:
+                self.add_queue(queue)
 
     def shutdown(self):
-        self.inport.close()
-        self.stream.stop_stream()
-        self.stream.close()
-        self.p.terminate()
+        if self.analyzer is not None:
+            self.analyzer.stop()
+        self.close()
+        print(self.stats.readout())
+        if self.pool_error is not None:
+            print(f"render threads stopped: {self.pool_error!r}")
+        if self.attacks is not None:
+            print(f"attack cache: {self.attacks.stats()}")
+        if self.midi is not None:
+            ignored = self.midi.ignored()
+            if ignored:
+                print(f"ignored MIDI: {ignored}")
+            self.midi.close()
+        if self.audio is not None:
+            self.audio.close()
 
 
 if __name__ == '__main__':
+    from PyQt5.QtWidgets import QApplication
+    from gui import GUI
     app = QApplication(sys.argv)
     window = GUI()
     sys.exit(app.exec_())
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import numpy as np
+from wavfile import STREAM_HEADER_SIZE, streaming_header
+
+# Seconds between writer passes
+PERIOD = 0.25
+# Most frames copied out of the ring per pass
+BATCH_FRAMES = 1 << 15
+# Frames of the file mapped at a time, and grown by when it fills up
+WINDOW_FRAMES = 1 << 20
+
+
+class Recorder:
+    # Records everything written to a SampleRing (the engine's output) into
+    # a WAV file, RF64 once past 4 GiB. The audio thread only does the ring
+    # write it does anyway; a writer thread follows behind, copies batches
+    # out of the ring and stores them through a memory mapped window onto
+    # the file. Only one window is mapped at a time, so memory use stays
+    # flat however long the session runs. Frames the writer was too slow
+    # for are overwritten in the ring before it gets to them; they are
+    # written as silence, keeping the timing, and counted in dropped.
+    def __init__(self, ring, path, rate, fmt='int16', period=PERIOD):
+        self.ring = ring
+        self.path = path
+        self.rate = rate
+        self.fmt = fmt
+        self.period = period
+        self.dtype = np.dtype('<f4' if fmt == 'float32' else '<i2')
+        self.staging = np.zeros(BATCH_FRAMES, dtype=ring.data.dtype)
+        # Next ring frame to record, frames in the file, and the lost ones
+        self.pos = 0
+        self.frames = 0
+        self.dropped = 0
+        self.overruns = 0
+        self.window = None
+        self.window_start = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with open(self.path, 'wb') as f:
+            f.write(streaming_header(0, self.rate, fmt=self.fmt))
+        self.pos = self.ring.written
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Records up to the last frame written and fixes the header.
+        # Returns the length recorded in seconds.
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.frames / self.rate
+
+    def run(self):
+        while self.running:
+            time.sleep(self.period)
+            self.drain()
+        self.drain()
+        self.finish()
+
+    def drain(self):
+        ring = self.ring
+        while self.pos < ring.written:
+            lost = ring.written + ring.largest - ring.size - self.pos
+            if lost > 0:
+                self.lose(lost)
+                continue
+            count = min(ring.written - self.pos, BATCH_FRAMES)
+            batch = self.staging[:count]
+            done = 0
+            for view in ring.segments(self.pos, count):
+                batch[done:done + len(view)] = view
+                done += len(view)
+            # Whatever the writer overwrote while that copy ran is garbage
+            lost = ring.written + ring.largest - ring.size - self.pos
+            if lost > 0:
+                batch[:lost] = 0
+                self.dropped += min(lost, count)
+                self.overruns += 1
+            self.put(batch)
+            self.pos += count
+
+    def lose(self, count):
+        # Silence for frames that were gone before they could be copied
+        self.dropped += count
+        self.overruns += 1
+        while count > 0:
+            batch = self.staging[:min(count, BATCH_FRAMES)]
+            batch.fill(0)
+            self.put(batch)
+            self.pos += len(batch)
+            count -= len(batch)
+
+    def put(self, samples):
+        done = 0
+        while done < len(samples):
+            if self.window is None or self.frames - self.window_start == len(self.window):
+                self.next_window()
+            at = self.frames - self.window_start
+            count = min(len(samples) - done, len(self.window) - at)
+            np.copyto(self.window[at:at + count], samples[done:done + count], casting='unsafe')
+            self.frames += count
+            done += count
+
+    def next_window(self):
+        # Maps the next stretch of the file, growing it first
+        self.close_window()
+        offset = STREAM_HEADER_SIZE + self.frames * self.dtype.itemsize
+        size = offset + WINDOW_FRAMES * self.dtype.itemsize
+        if os.path.getsize(self.path) < size:
+            os.truncate(self.path, size)
+        self.window = np.memmap(self.path, self.dtype, 'r+', offset, (WINDOW_FRAMES,))
+        self.window_start = self.frames
+
+    def close_window(self):
+        if self.window is not None:
+            self.window.flush()
+            self.window = None
+
+    def finish(self):
+        # Cuts the preallocated tail off and writes the real sizes
+        self.close_window()
+        os.truncate(self.path, STREAM_HEADER_SIZE + self.frames * self.dtype.itemsize)
+        with open(self.path, 'r+b') as f:
+            f.write(streaming_header(self.frames, self.rate, fmt=self.fmt))
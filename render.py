@@ -0,0 +1,244 @@
+import argparse
+import bisect
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from psop import SAMPLERATE, MAX_OVERSAMPLE, SMOOTHING
+from oversample import FACTORS
+from preset import Preset
+from oscillators import OSCILLATORS
+from voices import VoicePool, POLYPHONY
+from attacks import AttackCache
+from wavfile import write_wav
+
+# Latency doesn't matter offline, so render in much larger blocks
+BLOCK_SIZE = 8192
+HEADROOM = 3
+# Longest release tail rendered after the last event, in seconds
+MAX_TAIL = 10
+# Sample type of parallel_render's per channel stems in shared memory. The
+# voices are mixed in float32 anyway, and float64 stems of a long file with
+# many channels can outgrow /dev/shm.
+STEM_DTYPE = np.float32
+
+
+class OfflineRenderer:
+    # Plays a MIDI file through a VoicePool without opening any audio or
+    # MIDI device. Events land on the exact sample they are timed for.
+    def __init__(self, polyphony=POLYPHONY, block_size=BLOCK_SIZE, algorithm=1, oscillator='exact',
+                 precision='float64', oversample=MAX_OVERSAMPLE, preset=None, attack_cache=0,
+                 smoothing=SMOOTHING):
+        # Rendered note starts up to attack_cache bytes, 0 for none
+        self.attacks = AttackCache(attack_cache) if attack_cache else None
+        self.voices = VoicePool(polyphony, dtype=np.dtype(precision).type, cache=self.attacks)
+        for voice in self.voices.voices:
+            voice.max_oversample = oversample
+            voice.smoothing = smoothing
+        # Every note starts with this patch
+        self.preset = preset or Preset(algorithm=algorithm, oscillator=oscillator)
+        self.block_size = block_size
+        self.global_vol = [128] * 16
+        self.pitch = [1] * 16
+        self.velocity = {}
+        self.render_time = 0
+
+    def load(self, path):
+        # Returns (sample offset, message) pairs for every channel message
+        import mido
+        events = []
+        now = 0
+        for msg in mido.MidiFile(path):
+            now += msg.time
+            if not msg.is_meta:
+                events.append((round(now * SAMPLERATE), msg))
+        return events
+
+    def replay(self, events):
+        # Applies the controller state of earlier events without playing notes
+        for offset, msg in events:
+            if msg.type in ('pitchwheel', 'control_change'):
+                self.handle(msg)
+
+    def release_frames(self):
+        # Upper bound on how long a released note keeps sounding
+        return max(math.ceil(1 / -timings[4]) for timings in self.preset.timings) + 1
+
+    def render(self, events, out=None):
+        end = events[-1][0] if events else 0
+        if out is None:
+            out = np.zeros(end + MAX_TAIL * SAMPLERATE)
+        start = time.perf_counter()
+        pos = 0
+        i = 0
+        # Whole blocks are rendered at once, events inside a block are cut in
+        # by the voices they affect on the exact frame they are timed for
+        while pos < len(out) and (i < len(events) or self.voices.active):
+            size = min(self.block_size, len(out) - pos)
+            while i < len(events) and events[i][0] < pos + size:
+                self.handle(events[i][1], events[i][0] - pos)
+                i += 1
+            out[pos:pos + size] += self.voices.render(size, HEADROOM)
+            pos += size
+        self.render_time = time.perf_counter() - start
+        return out[:pos]
+
+    def handle(self, msg, offset=0):
+        if msg.type == 'note_on' and msg.velocity > 0:
+            key = (msg.channel, msg.note)
+            voice = self.voices.note_on(key)
+            self.velocity[key] = msg.velocity
+            voice.schedule(offset, voice.start, self.preset,
+                           self.note_freq(msg.note) * self.pitch[msg.channel],
+                           msg.velocity * self.global_vol[msg.channel])
+        elif msg.type in ('note_on', 'note_off'):
+            self.voices.note_off((msg.channel, msg.note), offset)
+        elif msg.type == 'pitchwheel':
+            # pitch bend - 1 octave range, same as the live synth
+            self.pitch[msg.channel] = 2 ** (msg.pitch / 8192)
+            for key, voice in self.channel_voices(msg.channel):
+                voice.schedule(offset, voice.set_freq, self.note_freq(key[1]) * self.pitch[msg.channel])
+        elif msg.type == 'control_change' and msg.control == 7:
+            self.global_vol[msg.channel] = msg.value
+            for key, voice in self.channel_voices(msg.channel):
+                voice.schedule(offset, voice.set_vol, self.velocity[key] * msg.value)
+
+    def channel_voices(self, channel):
+        for i in self.voices.active:
+            key = self.voices.notes[i]
+            if key[0] == channel:
+                yield key, self.voices.voices[i]
+
+    def note_freq(self, note):
+        return self.preset.note_freq(note)
+
+
+def split(events, gap):
+    # Cuts one channel's events into independent segments. A cut is only
+    # made where no note is held and every release has had gap frames to
+    # finish, so no voice carries across it. Returns (start, end) ranges.
+    cuts = [0]
+    held = set()
+    last_off = 0
+    for offset, msg in events:
+        if msg.type == 'note_on' and msg.velocity > 0:
+            if not held and offset - last_off >= gap and offset > cuts[-1]:
+                cuts.append(offset)
+            held.add(msg.note)
+        elif msg.type in ('note_on', 'note_off'):
+            held.discard(msg.note)
+            if not held:
+                last_off = offset
+    return list(zip(cuts, cuts[1:] + [None]))
+
+
+def render_job(job):
+    # Runs in a worker process: renders one channel segment into its stem,
+    # which lives in shared memory owned by the parent
+    name, shape, channel, start, end, before, events, args = job
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        stems = np.ndarray(shape, dtype=STEM_DTYPE, buffer=shm.buf)
+        renderer = OfflineRenderer(*args)
+        renderer.replay(before)
+        shifted = [(offset - start, msg) for offset, msg in events]
+        renderer.render(shifted, stems[channel, start:end])
+        del stems
+    finally:
+        shm.close()
+    return len(events)
+
+
+def parallel_render(path, jobs=None, polyphony=POLYPHONY, block_size=BLOCK_SIZE, algorithm=1,
+                    oscillator='exact', precision='float64', oversample=MAX_OVERSAMPLE,
+                    preset=None, attack_cache=0, smoothing=SMOOTHING):
+    # Renders each MIDI channel, and each independent time segment of it, in
+    # its own process. Every channel gets one stem row in a shared memory
+    # block and the stems are summed straight out of it at the end.
+    args = (polyphony, block_size, algorithm, oscillator, precision, oversample, preset,
+            attack_cache, smoothing)
+    probe = OfflineRenderer(*args)
+    events = probe.load(path)
+    if not events:
+        return np.zeros(0), 0
+    gap = probe.release_frames()
+    channels = sorted({msg.channel for offset, msg in events})
+    length = events[-1][0] + MAX_TAIL * SAMPLERATE
+    shape = (len(channels), length)
+    size = np.dtype(STEM_DTYPE).itemsize * shape[0] * shape[1]
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        stems = np.ndarray(shape, dtype=STEM_DTYPE, buffer=shm.buf)
+        stems.fill(0)
+        work = []
+        for row, channel in enumerate(channels):
+            own = [e for e in events if e[1].channel == channel]
+            offsets = [e[0] for e in own]
+            for start, end in split(own, gap):
+                first = bisect.bisect_left(offsets, start)
+                last = len(own) if end is None else bisect.bisect_left(offsets, end)
+                work.append((shm.name, shape, row, start, end, own[:first], own[first:last], args))
+        # Biggest jobs first so the pool doesn't finish on one long straggler
+        work.sort(key=lambda job: len(job[6]), reverse=True)
+        begin = time.perf_counter()
+        with ProcessPoolExecutor(jobs) as pool:
+            list(pool.map(render_job, work))
+        out = stems.sum(axis=0, dtype=np.float64)
+        elapsed = time.perf_counter() - begin
+        del stems
+    finally:
+        shm.close()
+        shm.unlink()
+    # Trim the unused tail space
+    last = np.flatnonzero(out)
+    return out[:last[-1] + 1 if len(last) else 0], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a MIDI file to WAV offline.')
+    parser.add_argument('midi')
+    parser.add_argument('wav')
+    parser.add_argument('--format', choices=['int16', 'float32'], default='int16')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--polyphony', type=int, default=POLYPHONY)
+    parser.add_argument('--algorithm', type=int, default=1)
+    parser.add_argument('--oscillator', choices=list(OSCILLATORS), default='exact')
+    parser.add_argument('--precision', choices=['float64', 'float32'], default='float64',
+                        help='sample type the voices are rendered in')
+    parser.add_argument('--oversample', type=int, choices=FACTORS, default=MAX_OVERSAMPLE,
+                        help='highest factor voices may oversample by, 1 for none')
+    parser.add_argument('--preset', help='JSON or binary preset file, overrides --algorithm '
+                        'and --oscillator')
+    parser.add_argument('--attack-cache', type=int, default=0, metavar='MB',
+                        help='replay cached note starts from up to this much memory')
+    parser.add_argument('--smoothing', type=float, default=SMOOTHING, metavar='SECONDS',
+                        help='time constant of mod, volume and pitch changes, 0 to jump')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='worker processes, 0 for one per core')
+    args = parser.parse_args()
+    preset = Preset.load(args.preset) if args.preset else None
+    attack_cache = args.attack_cache << 20
+
+    if args.jobs == 1:
+        renderer = OfflineRenderer(args.polyphony, args.block_size, args.algorithm,
+                                   args.oscillator, args.precision, args.oversample, preset,
+                                   attack_cache, args.smoothing)
+        data = renderer.render(renderer.load(args.midi))
+        elapsed = renderer.render_time
+        if renderer.attacks is not None:
+            print(f"attack cache: {renderer.attacks.stats()}")
+    else:
+        data, elapsed = parallel_render(args.midi, args.jobs or None, args.polyphony,
+                                        args.block_size, args.algorithm, args.oscillator,
+                                        args.precision, args.oversample, preset, attack_cache,
+                                        args.smoothing)
+    write_wav(args.wav, data, SAMPLERATE, args.format)
+    length = len(data) / SAMPLERATE
+    # A file without channel messages renders nothing in no time
+    speed = f" ({length / elapsed:.1f}x real time)" if elapsed else ""
+    print(f"rendered {length:.1f} s in {elapsed:.1f} s{speed}")
+
+
+if __name__ == '__main__':
+    main()
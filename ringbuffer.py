@@ -0,0 +1,66 @@
+import numpy as np
+
+RING_SIZE = 1 << 16
+
+
+class SampleRing:
+    # Ring of the most recent audio written by one thread, usually the audio
+    # callback, for any number of reader threads. The writer never waits:
+    # it overwrites the oldest frames and then publishes the new total in
+    # written. Readers never touch shared state, they copy what they want
+    # and then check that the writer hasn't lapped them while they did.
+    def __init__(self, size=RING_SIZE, dtype=np.float32):
+        self.size = size
+        self.raw = bytearray(size * np.dtype(dtype).itemsize)
+        self.data = np.frombuffer(self.raw, dtype=dtype)
+        # Frames written since the start, and the biggest single write
+        self.written = 0
+        self.largest = 0
+
+    def write(self, block):
+        count = len(block)
+        if count > self.size:
+            block = block[-self.size:]
+            self.written += count - self.size
+            count = self.size
+        self.largest = max(self.largest, count)
+        pos = self.written % self.size
+        first = min(count, self.size - pos)
+        self.data[pos:pos + first] = block[:first]
+        self.data[:count - first] = block[first:]
+        # Publish only once the frames are in place
+        self.written += count
+
+    def segments(self, start, count):
+        # One or two views of the ring holding frames start..start + count,
+        # zero copy. Check intact(start) after using them.
+        pos = start % self.size
+        first = min(count, self.size - pos)
+        if first == count:
+            return (self.data[pos:pos + count],)
+        return self.data[pos:], self.data[:count - first]
+
+    def intact(self, start):
+        # True while frame start and everything after it has not been
+        # overwritten, allowing for a write that is under way but not yet
+        # published
+        return start >= self.written + self.largest - self.size
+
+    def read(self, start, out):
+        # Copies frames start..start + len(out) into out. Returns False if
+        # the writer overwrote any of them first, out is garbage then.
+        if not self.intact(start):
+            return False
+        pos = 0
+        for view in self.segments(start, len(out)):
+            out[pos:pos + len(view)] = view
+            pos += len(view)
+        return self.intact(start)
+
+    def latest(self, out):
+        # Fills out with the newest frames, returns the frame number of the
+        # first one or -1 if there aren't enough yet or the copy was overrun
+        start = self.written - len(out)
+        if start < 0 or not self.read(start, out):
+            return -1
+        return start
@@ -0,0 +1,76 @@
+import time
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from analyzer import FLOOR, min_max, log_bands, band_peaks
+
+
+class ScopeCanvas(FigureCanvas):
+    # Waveform and spectrum of the analyzer's latest frame. The axes and
+    # lines are made once and each refresh only redraws the two lines over
+    # a cached background (blitting). Frames are shrunk to about a point
+    # per pixel column first, and the refresh interval follows what a
+    # redraw actually costs so the display stays a small share of the GUI
+    # thread.
+    COLUMNS = 400
+    BANDS = 200
+    # Longest share of the time redrawing may take, and the interval limits
+    LOAD = 0.05
+    MIN_INTERVAL = 33
+    MAX_INTERVAL = 500
+
+    def __init__(self, synth):
+        super(ScopeCanvas, self).__init__(Figure(figsize=(5, 3)))
+        self.synth = synth
+        self.analyzer = synth.analyzer
+        full_scale = self.analyzer.full_scale
+        self.wave_ax, self.spectrum_ax = self.figure.subplots(2)
+        self.wave_points = np.zeros(2 * self.COLUMNS, dtype=np.float32)
+        self.wave_line, = self.wave_ax.plot(np.arange(2 * self.COLUMNS) / 2, self.wave_points,
+                                            '-', lw=1, animated=True)
+        self.wave_ax.set_xlim(0, self.COLUMNS)
+        self.wave_ax.set_ylim(-full_scale, full_scale)
+        self.wave_ax.set_xticks([])
+        self.bands = log_bands(self.analyzer.freqs, self.BANDS)
+        self.band_points = np.full(len(self.bands), FLOOR)
+        self.spectrum_line, = self.spectrum_ax.semilogx(
+            self.analyzer.freqs[self.bands], self.band_points, '-', lw=1, animated=True)
+        self.spectrum_ax.set_xlim(20, self.analyzer.freqs[-1])
+        self.spectrum_ax.set_ylim(FLOOR, 0)
+        self.background = None
+        self.shown = -1
+        self.cost = 0.0
+        self.mpl_connect('draw_event', self.on_draw)
+        self.timer = self.new_timer(100, [(self.refresh, (), {})])
+        self.timer.start()
+
+    def on_draw(self, event):
+        # Full redraws (first show, resizes) renew the cached background
+        self.background = self.copy_from_bbox(self.figure.bbox)
+        self.draw_lines()
+
+    def draw_lines(self):
+        self.wave_ax.draw_artist(self.wave_line)
+        self.spectrum_ax.draw_artist(self.spectrum_line)
+
+    def refresh(self):
+        start = time.perf_counter()
+        frame, wave, spectrum = self.analyzer.latest()
+        if self.background is None or frame == self.shown:
+            return
+        min_max(wave, self.COLUMNS, self.wave_points)
+        band_peaks(spectrum, self.bands, self.band_points)
+        # The frame's buffer is only reused after the next one is out, if
+        # that happened while copying try again next time
+        if self.analyzer.published != frame:
+            return
+        self.shown = frame
+        self.wave_line.set_ydata(self.wave_points)
+        self.spectrum_line.set_ydata(self.band_points)
+        self.restore_region(self.background)
+        self.draw_lines()
+        self.blit(self.figure.bbox)
+        # Smoothed cost of a refresh sets the next interval
+        self.cost += 0.2 * (time.perf_counter() - start - self.cost)
+        interval = int(1000 * self.cost / self.LOAD)
+        self.timer.interval = min(max(interval, self.MIN_INTERVAL), self.MAX_INTERVAL)
@@ -12,12 +12,8 @@
 
 import time
 import struct
-from scipy.fft import fft
-import pyaudio
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-matplotlib.use("Qt5Agg")  # Setup QT5 backend
+from analyzer import FLOOR
 
 __author__ = 'David Kim'
 __copyright__ = 'Copyright (c) 2020 David Kim'
@@ -31,17 +27,32 @@ __status__ = 'Production'
 ##############################################################################
 
 
+def pyplot():
+    """ matplotlib on the QT5 backend, loaded on first use. """
+    import matplotlib
+    matplotlib.use("Qt5Agg")  # Setup QT5 backend
+    import matplotlib.pyplot as plt
+    return plt
+
+
 class SpectrumAnalyzer:
-    def __init__(self, p=None, stream=None):
-        """ Constructor. """
+    def __init__(self, p=None, stream=None, analyzer=None):
+        """ Constructor. Given an analyzer.Analyzer, shows its frames instead
+        of opening a stream of its own. """
         # Stream constants
-        self.FORMAT = pyaudio.paInt16
+        self.FORMAT = None
         self.CHANNELS = 1
         self.RATE = 48000
         self.CHUNK = 1024 * 2
+        self.analyzer = analyzer
 
         # Setup the stream
-        if not p and not stream:
+        if analyzer:
+            self.p = None
+            self.stream = None
+        elif not p and not stream:
+            import pyaudio
+            self.FORMAT = pyaudio.paInt16
             self.p = pyaudio.PyAudio()
             self.stream = self.p.open(
                 format=self.FORMAT,
@@ -70,6 +81,7 @@ class SpectrumAnalyzer:
         xf = np.linspace(0, self.RATE, self.CHUNK)
 
         # Setup matplotlib figure and axes
+        plt = pyplot()
         self.fig, (ax1, ax2) = plt.subplots(2, figsize=(15, 7))
         self.fig.canvas.mpl_connect('button_press_event', self.onclick)
 
@@ -102,6 +114,42 @@ class SpectrumAnalyzer:
         # Show analyzer
         plt.show(block=False)
 
+    def setup_ring_analyzer(self):
+        """ Setup the figure for frames from an Analyzer. """
+        size = self.analyzer.size
+        plt = pyplot()
+        self.fig, (ax1, ax2) = plt.subplots(2, figsize=(15, 7))
+        self.fig.canvas.mpl_connect('button_press_event', self.onclick)
+        self.line, = ax1.plot(np.arange(size), np.zeros(size), '-', lw=2)
+        self.line_fft, = ax2.semilogx(
+            self.analyzer.freqs[1:], np.zeros(size // 2), '-', lw=2)
+        ax1.set_title('AUDIO WAVEFORM')
+        ax1.set_xlabel('samples')
+        ax1.set_ylabel('volume')
+        ax1.set_xlim(0, size)
+        ax1.set_ylim(-1 / self.analyzer.scale, 1 / self.analyzer.scale)
+        ax2.set_xlim(20, self.RATE / 2)
+        ax2.set_ylim(FLOOR, 0)
+        ax2.set_ylabel('dB')
+        plt.show(block=False)
+
+    def start_ring_analyzer(self):
+        """ Redraw whenever the Analyzer publishes a new frame. """
+        self.frame_count = 0
+        self.start_time = time.time()
+        shown = self.analyzer.published
+        while not self.should_exit:
+            frame, wave, spectrum = self.analyzer.latest()
+            if frame != shown:
+                shown = frame
+                self.line.set_ydata(wave)
+                self.line_fft.set_ydata(spectrum[1:])
+                self.fig.canvas.draw()
+                self.frame_count += 1
+            self.fig.canvas.flush_events()
+            time.sleep(self.analyzer.period / 4)
+        self.exit()
+
     def start_analyzer(self):
         """ Start the analyzer. """
         print('stream started')
@@ -116,7 +164,7 @@ class SpectrumAnalyzer:
             self.line.set_ydata(data_np)
 
             # Compute FFT and update line
-            yf = fft(data_int)
+            yf = np.fft.fft(data_int)
             self.line_fft.set_ydata(
                 np.abs(yf[0:self.CHUNK]) / (128 * self.CHUNK))
 
@@ -136,12 +184,17 @@ class SpectrumAnalyzer:
         """ Close the stream and exit the application. """
         frame_rate = self.frame_count / (time.time() - self.start_time)
         print('average frame rate = {:.0f} FPS'.format(frame_rate))
-        print('stream closed')
-        self.p.close(self.stream)
+        if self.stream:
+            print('stream closed')
+            self.p.close(self.stream)
 
     def start(self):
-        self.setup_analyzer()
-        self.start_analyzer()
+        if self.analyzer:
+            self.setup_ring_analyzer()
+            self.start_ring_analyzer()
+        else:
+            self.setup_analyzer()
+            self.start_analyzer()
 
 ##############################################################################
 
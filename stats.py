@@ -0,0 +1,118 @@
+import json
+import numpy as np
+import psop
+
+# PortAudio callback status flags
+OUTPUT_UNDERFLOW = 4
+OUTPUT_OVERFLOW = 8
+
+# Per block timings in seconds, the operator stages last
+FIELDS = ('total', 'events', 'render', 'output') + psop.STAGES
+HISTORY = 4096
+
+
+class CallbackStats:
+    # Keeps the last HISTORY audio blocks' timings in preallocated arrays so
+    # recording a block costs a few array writes and nothing else
+    def __init__(self, size=HISTORY, voices=32):
+        self.size = size
+        self.times = np.zeros((size, len(FIELDS)))
+        # The psop.STAGES columns, added to by whoever renders the block.
+        # They stay zero unless the engine has its stages timed.
+        self.stage_times = self.times[:, len(FIELDS) - len(psop.STAGES):]
+        self.alg_times = np.zeros((size, len(psop.alg)))
+        # Render time of each voice by pool index, a batched voice getting
+        # an even share of its batch
+        self.voice_times = np.zeros((size, voices))
+        self.deadline = np.zeros(size)
+        self.status = np.zeros(size, dtype=np.int64)
+        self.voices = np.zeros(size, dtype=np.int64)
+        self.count = 0
+        self.underflows = 0
+        self.overflows = 0
+
+    def begin(self):
+        # Clears and returns the row for the block about to be rendered
+        row = self.count % self.size
+        self.alg_times[row] = 0
+        self.voice_times[row] = 0
+        self.stage_times[row] = 0
+        return row
+
+    def record(self, row, deadline, status, voices, start, events, render, output):
+        # start..output are perf_counter() readings between the stages
+        times = self.times[row]
+        times[0] = output - start
+        times[1] = events - start
+        times[2] = render - events
+        times[3] = output - render
+        self.deadline[row] = deadline
+        self.status[row] = status
+        self.voices[row] = voices
+        if status & OUTPUT_UNDERFLOW:
+            self.underflows += 1
+        if status & OUTPUT_OVERFLOW:
+            self.overflows += 1
+        self.count += 1
+
+    def filled(self):
+        return min(self.count, self.size)
+
+    def margin(self):
+        # Seconds left before each block's deadline, negative means late
+        n = self.filled()
+        return self.deadline[:n] - self.times[:n, 0]
+
+    def summary(self):
+        # p50/p99/max of every timing in milliseconds, plus xrun counts
+        n = self.filled()
+        result = {'blocks': self.count, 'underflows': self.underflows,
+                  'overflows': self.overflows}
+        if n == 0:
+            return result
+        for i, name in enumerate(FIELDS):
+            result[name] = percentiles(self.times[:n, i])
+        for i in range(self.alg_times.shape[1]):
+            if self.alg_times[:n, i].any():
+                result[f'alg{i}'] = percentiles(self.alg_times[:n, i])
+        # Every voice render in the history, and the slowest voice of each block
+        voice_times = self.voice_times[:n]
+        if voice_times.any():
+            result['voice'] = percentiles(voice_times[voice_times > 0])
+            result['slowest_voice'] = percentiles(voice_times.max(axis=1))
+        margin = self.margin()
+        result['margin'] = {'min': margin.min() * 1000, 'p50': np.percentile(margin, 50) * 1000}
+        result['late'] = int((margin < 0).sum())
+        result['voices'] = {'p50': float(np.percentile(self.voices[:n], 50)),
+                            'max': int(self.voices[:n].max())}
+        return result
+
+    def histogram(self, field='total', bins=20):
+        # (counts, bin edges in ms) of one of FIELDS over the kept history
+        n = self.filled()
+        return np.histogram(self.times[:n, FIELDS.index(field)] * 1000, bins=bins)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def readout(self):
+        # One line for a live display
+        n = self.filled()
+        if n == 0:
+            return "no blocks yet"
+        total = self.times[:n, 0] * 1000
+        last = (self.count - 1) % self.size
+        return (f"render p50 {np.percentile(total, 50):.2f} ms  "
+                f"p99 {np.percentile(total, 99):.2f} ms  "
+                f"deadline {self.deadline[last] * 1000:.1f} ms  "
+                f"xruns {self.underflows + self.overflows}  "
+                f"voices {self.voices[last]}  "
+                f"slowest voice {self.voice_times[last].max() * 1000:.2f} ms")
+
+
+def percentiles(values):
+    values = values * 1000
+    return {'p50': float(np.percentile(values, 50)),
+            'p99': float(np.percentile(values, 99)),
+            'max': float(values.max())}
@@ -0,0 +1,138 @@
+import time
+import numpy as np
+from psop import Synth, VoiceBank, DTYPE
+
+POLYPHONY = 32
+
+
+class VoicePool:
+    def __init__(self, size=POLYPHONY, steal='oldest', dtype=DTYPE, cache=None):
+        self.voices = [Synth(dtype) for i in range(size)]
+        # Optional attacks.AttackCache of note starts, shared by every voice
+        self.cache = cache
+        for voice in self.voices:
+            voice.cache = cache
+        self.notes = [None] * size
+        self.held = [False] * size
+        # Indices of sounding voices, oldest note first. Only these get
+        # rendered, so idle voices cost nothing.
+        self.active = []
+        self.free = list(range(size - 1, -1, -1))
+        self.steal = steal
+        self.bank = VoiceBank(size)
+        # Per-voice float32 output rows, reused every block
+        self.scratch = np.zeros((size, 0), dtype=np.float32)
+
+    def note_on(self, note):
+        # Retrigger a voice already playing this note before taking a new one
+        for i in self.active:
+            if self.notes[i] == note:
+                self.active.remove(i)
+                break
+        else:
+            if self.free:
+                i = self.free.pop()
+                # Nothing should be waiting on an idle voice, and a new
+                # note mustn't replay it if it is
+                self.voices[i].events.clear()
+            else:
+                i = self.pick_victim()
+                self.active.remove(i)
+        self.notes[i] = note
+        self.held[i] = True
+        self.active.append(i)
+        return self.voices[i]
+
+    def note_off(self, note, offset=0):
+        for i in self.active:
+            if self.notes[i] == note and self.held[i]:
+                self.held[i] = False
+                self.voices[i].schedule(offset, self.voices[i].release)
+
+    def time_stages(self):
+        # Times the envelope and oscillator stages of every voice and of the
+        # bank, see psop.timed
+        for voice in self.voices:
+            voice.time_stages()
+        self.bank.time_stages()
+
+    def pick_victim(self):
+        # Released voices go first, they are already on their way out
+        released = [i for i in self.active if not self.held[i]] or self.active
+        if self.steal == 'quietest':
+            return min(released, key=lambda i: self.voices[i].level())
+        return released[0]
+
+    def sounding(self):
+        return [self.voices[i] for i in self.active]
+
+    def reap(self):
+        # Return voices whose envelopes have all finished to the free list
+        for i in [i for i in self.active if not self.voices[i].is_active()
+                  and not self.voices[i].events]:
+            self.active.remove(i)
+            self.notes[i] = None
+            self.held[i] = False
+            self.free.append(i)
+
+    def render(self, frame_count, headroom=1, timings=None, out=None, voice_times=None):
+        # Adds every sounding voice into out (float32, frame_count long) and
+        # returns it. Without out a new buffer is made, which is fine
+        # offline; the live callback passes its MixBus buffer instead.
+        # timings, if given, is an array indexed by algorithm that gets the
+        # seconds spent rendering each algorithm added to it, and
+        # voice_times one indexed by voice that gets each voice's.
+        if out is None:
+            out = np.zeros(frame_count, dtype=np.float32)
+        if frame_count > self.scratch.shape[1]:
+            self.scratch = np.zeros((len(self.voices), frame_count), dtype=np.float32)
+        self.render_some(tuple(self.active), frame_count, out, self.bank, self.scratch,
+                         timings, voice_times)
+        if headroom != 1:
+            out *= 1 / headroom
+        self.reap()
+        return out
+
+    def render_some(self, indices, frame_count, out, bank, scratch, timings=None,
+                    voice_times=None):
+        # Adds the voices at indices into out. The bank and the scratch
+        # buffers (at least len(indices) rows) are the caller's, so callers
+        # on different threads can each render their own share of voices.
+        # One batched render per algorithm in use instead of one per voice.
+        # Voices with events this block render alone so they can be cut at
+        # each event's exact frame, and so do voices playing a cached note
+        # start, which is only a copy, voices recording one and voices with
+        # a parameter gliding.
+        groups = {}
+        for n, i in enumerate(indices):
+            voice = self.voices[i]
+            if (voice.events or voice.attack is not None or voice.recording is not None
+                    or voice.glides):
+                start = time.perf_counter()
+                row = scratch[n, :frame_count]
+                voice.get_samples(frame_count, voice.events, row)
+                voice.events.clear()
+                np.add(out, row, out=out)
+                elapsed = time.perf_counter() - start
+                if timings is not None:
+                    timings[voice.algorithm] += elapsed
+                if voice_times is not None:
+                    voice_times[i] += elapsed
+            else:
+                voice.choose_oversample()
+                groups.setdefault(voice.batch_key(), []).append(i)
+        for key, members in groups.items():
+            start = time.perf_counter()
+            group = [self.voices[i] for i in members]
+            rows = scratch[:len(group), :frame_count]
+            bank.get_samples(group, frame_count, rows)
+            # Row by row, a sum over the voice axis would buffer
+            for row in rows:
+                np.add(out, row, out=out)
+            elapsed = time.perf_counter() - start
+            if timings is not None:
+                timings[key[0]] += elapsed
+            if voice_times is not None:
+                for i in members:
+                    voice_times[i] += elapsed / len(members)
+        return out
@@ -0,0 +1,53 @@
+import struct
+import numpy as np
+
+# WAVE format tags
+PCM = 1
+IEEE_FLOAT = 3
+
+
+def wav_header(num_frames, rate, channels=1, fmt='int16'):
+    # Canonical 44 byte RIFF header for 16-bit PCM or 32-bit float samples
+    tag, width = (IEEE_FLOAT, 4) if fmt == 'float32' else (PCM, 2)
+    data_size = num_frames * channels * width
+    return (b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE'
+            + b'fmt ' + struct.pack('<IHHIIHH', 16, tag, channels, rate,
+                                    rate * channels * width, channels * width, width * 8)
+            + b'data' + struct.pack('<I', data_size))
+
+
+# Size of streaming_header(), which leaves room to become RF64 in place
+STREAM_HEADER_SIZE = 80
+RIFF_LIMIT = 0xFFFFFFFF
+
+
+def streaming_header(num_frames, rate, channels=1, fmt='int16'):
+    # Header for a file written before its length is known. It carries a
+    # 28 byte JUNK chunk, which becomes the ds64 chunk of an RF64 file
+    # (EBU Tech 3306) if the data outgrows what RIFF's 32 bit sizes hold.
+    tag, width = (IEEE_FLOAT, 4) if fmt == 'float32' else (PCM, 2)
+    data_size = num_frames * channels * width
+    riff_size = STREAM_HEADER_SIZE - 8 + data_size
+    fmt_chunk = b'fmt ' + struct.pack('<IHHIIHH', 16, tag, channels, rate,
+                                      rate * channels * width, channels * width, width * 8)
+    if riff_size <= RIFF_LIMIT:
+        return (b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+                + b'JUNK' + struct.pack('<I', 28) + bytes(28)
+                + fmt_chunk + b'data' + struct.pack('<I', data_size))
+    return (b'RF64' + struct.pack('<I', RIFF_LIMIT) + b'WAVE'
+            + b'ds64' + struct.pack('<IQQQI', 28, riff_size, data_size, num_frames, 0)
+            + fmt_chunk + b'data' + struct.pack('<I', RIFF_LIMIT))
+
+
+def to_format(data, fmt='int16'):
+    # data is float in the synth's int16 scale, clipped to full scale here
+    if fmt == 'float32':
+        return np.clip(data / 32768, -1, 1).astype(np.float32)
+    return np.clip(data, -32768, 32767).astype(np.int16)
+
+
+def write_wav(path, data, rate, fmt='int16'):
+    samples = to_format(data, fmt)
+    with open(path, 'wb') as f:
+        f.write(wav_header(len(samples), rate, fmt=fmt))
+        f.write(samples.astype('<' + samples.dtype.str[1:], copy=False).tobytes())
@@ -0,0 +1,236 @@
+import os
+import threading
+import time
+import numpy as np
+from psop import STAGES, VoiceBank, alg, take_stage_times
+
+# Render threads, 0 for one per core
+WORKERS = 0
+# Blocks rendered ahead of the one being played. Each adds a block of
+# latency and lets a render run that much longer before the output waits.
+AHEAD = 1
+
+
+class Worker:
+    # One render thread with its own VoiceBank and buffers. It renders the
+    # voices it was handed for a block into out and sets done.
+    def __init__(self, pool, capacity):
+        self.pool = pool
+        self.bank = VoiceBank(capacity)
+        self.scratch = np.zeros((capacity, 0), dtype=np.float32)
+        self.out = np.zeros(0, dtype=np.float32)
+        self.timings = np.zeros(len(alg))
+        self.voice_times = np.zeros(capacity)
+        # Seconds in each of psop.STAGES, when they are timed
+        self.stage_times = np.zeros(len(STAGES))
+        self.indices = []
+        self.frame_count = 0
+        # Seconds the last block took, and a smoothed load for balancing
+        self.elapsed = 0.0
+        self.load = 0.0
+        # Whatever a render raised, left for the pool to notice
+        self.error = None
+        self.go = threading.Event()
+        self.done = threading.Event()
+        self.done.set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def resize(self, frames):
+        self.scratch = np.zeros((self.scratch.shape[0], frames), dtype=np.float32)
+        self.out = np.zeros(frames, dtype=np.float32)
+
+    def run(self):
+        while True:
+            self.go.wait()
+            self.go.clear()
+            if not self.pool.running:
+                break
+            start = time.perf_counter()
+            try:
+                out = self.out[:self.frame_count]
+                out.fill(0)
+                if self.indices:
+                    self.pool.voices.render_some(self.indices, self.frame_count, out, self.bank,
+                                                 self.scratch, self.timings,
+                                                 self.voice_times)
+                take_stage_times(self.stage_times)
+            except Exception as error:
+                self.error = error
+            finally:
+                # Nothing may be left waiting on a worker that failed
+                self.elapsed = time.perf_counter() - start
+                self.done.set()
+
+
+class RenderPool:
+    # Renders a VoicePool on worker threads, ahead blocks before they are
+    # played, so the audio callback only has to mix finished blocks. The
+    # heavy parts of a render are NumPy calls that let go of the GIL, so
+    # the threads really do run side by side.
+    #
+    # Only one block is in flight at a time and nothing touches the voices
+    # while it is. Each callback collects the finished block, and if that
+    # doesn't put the workers too far ahead applies the events that came
+    # in and launches the next one, then plays the oldest finished block.
+    # Blocks 0..ahead-1 are silence.
+    def __init__(self, voices, workers=WORKERS, ahead=AHEAD, frames=1024):
+        self.voices = voices
+        self.ahead = ahead
+        count = workers or os.cpu_count() or 1
+        self.running = True
+        self.workers = [Worker(self, len(voices.voices)) for i in range(count)]
+        # Finished blocks by block number % (ahead + 1)
+        self.blocks = np.zeros((ahead + 1, 0), dtype=np.float32)
+        self.sizes = [0] * (ahead + 1)
+        self.resize(frames)
+        self.launched = ahead
+        self.played = 0
+        self.busy = False
+        # Blocks whose output had to wait on the workers
+        self.stalls = 0
+        for worker in self.workers:
+            worker.thread.start()
+
+    def resize(self, frames):
+        # Only between blocks; finished blocks not yet played are kept
+        old = self.blocks
+        self.frames = frames
+        self.blocks = np.zeros((self.ahead + 1, frames), dtype=np.float32)
+        self.blocks[:, :old.shape[1]] = old
+        for worker in self.workers:
+            worker.resize(frames)
+
+    def time_stages(self):
+        # Times the envelope and oscillator stages of the workers' banks,
+        # the voices are timed by their VoicePool
+        for worker in self.workers:
+            worker.bank.time_stages()
+
+    def idle(self, timings=None, voice_times=None, stage_times=None):
+        # True once no block is in flight, collecting it if it has finished.
+        # Only waits for it if it is the next block to be played.
+        # timings, an array indexed by algorithm, gets its render times,
+        # voice_times, indexed by voice, each voice's and stage_times the
+        # time in each of psop.STAGES.
+        if not self.busy:
+            return True
+        due = self.played == self.launched - 1
+        if not all(worker.done.is_set() for worker in self.workers):
+            if not due:
+                return False
+            self.stalls += 1
+            for worker in self.workers:
+                worker.done.wait()
+        self.collect(timings, voice_times, stage_times)
+        return True
+
+    def collect(self, timings, voice_times=None, stage_times=None):
+        block = (self.launched - 1) % len(self.blocks)
+        mix = self.blocks[block, :self.sizes[block]]
+        mix.fill(0)
+        for worker in self.workers:
+            np.add(mix, worker.out[:len(mix)], out=mix)
+            worker.load += 0.1 * (worker.elapsed - worker.load)
+            if timings is not None:
+                timings += worker.timings
+            if voice_times is not None:
+                voice_times += worker.voice_times
+            if stage_times is not None:
+                stage_times += worker.stage_times
+            worker.timings.fill(0)
+            worker.voice_times.fill(0)
+            worker.stage_times.fill(0)
+        self.busy = False
+        self.voices.reap()
+
+    def ready(self):
+        # True if a block can be launched without running too far ahead
+        return self.launched <= self.played + self.ahead
+
+    def launch(self, frame_count):
+        # Starts rendering the next block of frame_count frames, after the
+        # caller has applied the events that land in it
+        if frame_count > self.frames:
+            self.resize(frame_count)
+        self.sizes[self.launched % len(self.sizes)] = frame_count
+        for worker, indices in zip(self.workers, self.assign()):
+            worker.indices = indices
+            worker.frame_count = frame_count
+            worker.done.clear()
+            worker.go.set()
+        self.launched += 1
+        self.busy = True
+
+    def play(self, out):
+        # Adds the next block into out (float32, frame_count long). Call
+        # idle first, it makes sure the block is finished.
+        block = self.played % len(self.blocks)
+        size = min(len(out), self.sizes[block])
+        np.add(out[:size], self.blocks[block, :size], out=out[:size])
+        self.played += 1
+        return out
+
+    def assign(self):
+        # Splits the sounding voices between the workers so their estimated
+        # costs come out even, longest first into the least loaded worker.
+        # Voices that batch together go in as few pieces as that allows.
+        groups = {}
+        for i in self.voices.active:
+            voice = self.voices.voices[i]
+            # A voice with events, a cached note start to play or record or a
+            # glide renders on its own anyway
+            alone = (voice.events or voice.attack is not None or voice.recording is not None
+                     or voice.glides)
+            key = i if alone else voice.batch_key()
+            groups.setdefault(key, []).append(i)
+        costs = {key: cost(self.voices.voices[members[0]]) for key, members in groups.items()}
+        share = sum(costs[key] * len(members) for key, members in groups.items()) / len(self.workers)
+        pieces = []
+        for key, members in groups.items():
+            per = max(1, int(share / costs[key]))
+            for start in range(0, len(members), per):
+                piece = members[start:start + per]
+                pieces.append((costs[key] * len(piece), piece))
+        pieces.sort(key=lambda piece: piece[0], reverse=True)
+        shares = [[] for worker in self.workers]
+        loads = [0.0] * len(self.workers)
+        for piece_cost, piece in pieces:
+            w = loads.index(min(loads))
+            shares[w] += piece
+            loads[w] += piece_cost
+        return shares
+
+    def error(self):
+        # The first error a worker hit, None while they all work. Once there
+        # is one the pool should be closed and the voices rendered without it.
+        for worker in self.workers:
+            if worker.error is not None:
+                return worker.error
+        return None
+
+    def latency(self, rate):
+        # Seconds of delay the pool adds on top of the stream's own
+        return self.ahead * self.frames / rate
+
+    def balance(self):
+        # Busiest worker's smoothed render time over the average, 1 is even
+        loads = [worker.load for worker in self.workers]
+        mean = sum(loads) / len(loads)
+        return max(loads) / mean if mean else 1.0
+
+    def close(self):
+        # Lets a block in flight finish first
+        for worker in self.workers:
+            worker.done.wait()
+        self.running = False
+        for worker in self.workers:
+            worker.go.set()
+            worker.thread.join()
+
+
+def cost(voice):
+    # Rough render cost of a voice: operators played times oversampling,
+    # next to nothing while it plays a cached note start
+    if voice.attack is not None:
+        return 0.1
+    return len(voice.used_ops()) * voice.oversample